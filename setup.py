@@ -14,6 +14,11 @@ try:
 except ImportError:
     install_requires.append('ordereddict')
 
+try:
+    import concurrent.futures
+except ImportError:
+    install_requires.append('futures')
+
 setup(
     name = 'django-cuddlybuddly-storage-s3',
     version = '3.3',
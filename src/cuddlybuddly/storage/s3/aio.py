@@ -0,0 +1,756 @@
+"""
+An asyncio version of AWSAuthConnection with its own connection pool, for
+making many concurrent requests from a single event loop, and the async
+counterparts of S3Storage's methods built on it.
+
+Requires Python 3.7 or later.
+"""
+import asyncio
+import contextvars
+from datetime import datetime
+import functools
+import http.client as httplib
+from io import BytesIO
+import time
+from urllib import parse as urlparse
+from django.core.files.base import File
+try:
+    from django.core.files.utils import validate_file_name
+except ImportError: # Django < 3.2
+    validate_file_name = None
+from cuddlybuddly.storage.s3.exceptions import S3Error
+from cuddlybuddly.storage.s3.lib import DEFAULT_CONNECT_TIMEOUT, \
+    DEFAULT_HOST, DEFAULT_READ_TIMEOUT, PORTS_BY_SECURITY, CallingFormat, \
+    DeadlineExceeded, EndpointCache, GetResponse, ListBucketResponse, \
+    Response, S3Exception, S3Object, build_host, build_path, \
+    canonical_string, current_timeouts, encode, merge_meta, min_timeout
+from cuddlybuddly.storage.s3.middleware import request_memo
+from cuddlybuddly.storage.s3.pool import DEFAULT_IDLE_TIMEOUT, \
+    DEFAULT_MAX_SIZE, create_ssl_context
+from cuddlybuddly.storage.s3.retry import RetryPolicy
+from cuddlybuddly.storage.s3.signals import request_retried
+
+
+DEFAULT_MAX_CONNECTIONS = 100
+CHUNK_SIZE = 64 * 1024
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """
+    Calls func in the event loop's default executor, for work that would
+    block the loop, with the current context so timeouts and the request memo
+    still apply.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+class AsyncHTTPResponse(object):
+    """
+    A response whose body has already been read, providing the parts of
+    httplib.HTTPResponse used by the Response classes.
+    """
+
+    def __init__(self, status, reason, msg, body=b''):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self._body = body
+
+    def read(self, amt=None):
+        if amt is None:
+            data, self._body = self._body, b''
+        else:
+            data, self._body = self._body[:amt], self._body[amt:]
+        return data
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def getheaders(self):
+        return list(self.msg.items())
+
+    def isclosed(self):
+        return not self._body
+
+
+class AsyncConnection(object):
+    """
+    A keep-alive HTTP/1.1 connection over asyncio streams.
+    """
+
+    def __init__(self, reader, writer, read_timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.read_timeout = read_timeout
+        self.will_close = False
+
+    def is_dropped(self):
+        return self.will_close or self.reader.at_eof() or \
+            self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.read_timeout)
+
+    async def request(self, method, host, path, headers, data):
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        if 'Accept-Encoding' not in headers:
+            lines.append('Accept-Encoding: identity')
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        self.writer.write(
+            ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+        )
+        if hasattr(data, 'read'):
+            while True:
+                chunk = data.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode('iso-8859-1')
+                self.writer.write(chunk)
+                await self._read(self.writer.drain())
+        elif data:
+            self.writer.write(data)
+        await self._read(self.writer.drain())
+
+    async def _read_headers(self):
+        lines = []
+        while True:
+            line = await self._read(self.reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line)
+        return httplib.parse_headers(BytesIO(b''.join(lines) + b'\r\n'))
+
+    async def getresponse(self, method):
+        while True:
+            line = await self._read(self.reader.readline())
+            if not line:
+                raise httplib.RemoteDisconnected(
+                    'Remote end closed connection without response'
+                )
+            try:
+                version, status, reason = line.decode('iso-8859-1') \
+                    .rstrip('\r\n').split(' ', 2)
+            except ValueError:
+                version, status = line.decode('iso-8859-1').split(' ', 1)
+                reason = ''
+            try:
+                status = int(status)
+            except ValueError:
+                raise httplib.BadStatusLine(line)
+            msg = await self._read_headers()
+            if status != 100:
+                break
+
+        if version == 'HTTP/1.0' or \
+           msg.get('Connection', '').lower() == 'close':
+            self.will_close = True
+
+        body = b''
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif msg.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                line = await self._read(self.reader.readline())
+                size = int(line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    await self._read_headers()
+                    break
+                chunks.append(await self._read(self.reader.readexactly(size)))
+                await self._read(self.reader.readexactly(2))
+            body = b''.join(chunks)
+        elif msg.get('Content-Length') is not None:
+            body = await self._read(
+                self.reader.readexactly(int(msg['Content-Length']))
+            )
+        else:
+            body = await self._read(self.reader.read())
+            self.will_close = True
+
+        return AsyncHTTPResponse(status, reason, msg, body)
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of idle keep-alive connections for one event loop, keyed by the
+    security and ``host:port`` of the endpoint. ``max_connections`` limits
+    the number of requests in flight at once.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self._loop = None
+        self._idle = {}
+        self._semaphore = None
+
+    def _check_loop(self):
+        # Streams belong to the loop that created them.
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._idle = {}
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+    @property
+    def semaphore(self):
+        self._check_loop()
+        return self._semaphore
+
+    def get(self, is_secure, host):
+        self._check_loop()
+        idle = self._idle.get((is_secure, host))
+        now = time.time()
+        while idle:
+            connection, last_used = idle.pop()
+            if now - last_used > self.idle_timeout or \
+               connection.is_dropped():
+                connection.close()
+            else:
+                return connection
+        return None
+
+    def put(self, is_secure, host, connection):
+        self._check_loop()
+        if connection.is_dropped():
+            connection.close()
+            return
+        idle = self._idle.setdefault((is_secure, host), [])
+        if len(idle) < self.max_size:
+            idle.append((connection, time.time()))
+        else:
+            connection.close()
+
+    async def connect(self, is_secure, host, ssl_context, timeout=None,
+                      read_timeout=None):
+        netloc = urlparse.urlsplit('//' + host)
+        hostname, port = netloc.hostname, netloc.port
+        if port is None:
+            port = PORTS_BY_SECURITY[is_secure]
+        kwargs = {}
+        if is_secure:
+            kwargs = {'ssl': ssl_context, 'server_hostname': hostname}
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(hostname, port, **kwargs),
+            timeout
+        )
+        return AsyncConnection(reader, writer, read_timeout)
+
+    def clear(self):
+        for connections in self._idle.values():
+            for connection, last_used in connections:
+                connection.close()
+        self._idle = {}
+
+
+class AsyncAWSAuthConnection(object):
+    """
+    The asyncio equivalent of AWSAuthConnection's ``get``, ``put``,
+    ``delete``, ``list_bucket`` and ``head``, returning the same response
+    classes.
+    """
+
+    def __init__(self, aws_access_key_id, aws_secret_access_key,
+                 is_secure=True, server=DEFAULT_HOST, port=None,
+                 calling_format=CallingFormat.SUBDOMAIN, pool=None,
+                 ssl_context=None, endpoint_ttl=EndpointCache.DEFAULT_TTL,
+                 retry_policy=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, deadline=None,
+                 rate_limiter=None):
+        if not port:
+            port = PORTS_BY_SECURITY[is_secure]
+        if pool is None:
+            pool = AsyncConnectionPool()
+        if ssl_context is None:
+            ssl_context = create_ssl_context()
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.is_secure = is_secure
+        self.server = server
+        self.port = port
+        self.calling_format = calling_format
+        self.pool = pool
+        self.ssl_context = ssl_context
+        self.endpoints = EndpointCache(endpoint_ttl)
+        self.retry_policy = retry_policy
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.rate_limiter = rate_limiter
+
+    @classmethod
+    def from_connection(cls, connection):
+        """
+        Returns an async connection with the same settings as an
+        AWSAuthConnection.
+        """
+        return cls(
+            connection.aws_access_key_id,
+            connection.aws_secret_access_key,
+            is_secure=connection.is_secure,
+            server=connection.server,
+            port=connection.port,
+            calling_format=connection.calling_format,
+            ssl_context=connection.ssl_context,
+            endpoint_ttl=connection.endpoints.ttl,
+            retry_policy=connection.retry_policy,
+            connect_timeout=connection.connect_timeout,
+            read_timeout=connection.read_timeout,
+            deadline=connection.deadline,
+            rate_limiter=connection.rate_limiter
+        )
+
+    async def list_bucket(self, bucket, options={}, headers={}):
+        return ListBucketResponse(
+                await self._make_request('GET', bucket, '', options, headers))
+
+    async def put(self, bucket, key, object, headers={}):
+        if not isinstance(object, S3Object):
+            object = S3Object(object)
+
+        return Response(
+                await self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    {},
+                    headers,
+                    object.data,
+                    object.metadata))
+
+    async def get(self, bucket, key, headers={}):
+        return GetResponse(
+                await self._make_request('GET', bucket, key, {}, headers))
+
+    async def head(self, bucket, key, headers={}):
+        return Response(
+                await self._make_request('HEAD', bucket, key, {}, headers))
+
+    async def delete(self, bucket, key, headers={}):
+        return Response(
+                await self._make_request('DELETE', bucket, key, {}, headers))
+
+    async def close(self):
+        self.pool.clear()
+
+    def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
+        if not 'Date' in headers:
+            headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
+        c_string = canonical_string(method, bucket, key, query_args, headers)
+        headers['Authorization'] = \
+            "AWS %s:%s" % (self.aws_access_key_id, encode(self.aws_secret_access_key, c_string))
+
+    def _endpoint_key(self, bucket):
+        return (self.is_secure, self.server, self.port, self.calling_format, bucket)
+
+    def _remaining(self, expires):
+        if expires is None:
+            return None
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('The deadline for the request to S3 passed.')
+        return remaining
+
+    async def _make_request(self, method, bucket='', key='', query_args={},
+                            headers={}, data=b'', metadata={}):
+        server = build_host(bucket, self.server, self.calling_format)
+        path = build_path(bucket, key, query_args, self.calling_format)
+        if isinstance(data, str):
+            data = data.encode('iso-8859-1')
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        expires = None
+        if self.deadline is not None:
+            expires = time.time() + self.deadline
+        overrides = current_timeouts()
+        if overrides is not None:
+            if overrides.connect is not None:
+                connect_timeout = overrides.connect
+            if overrides.read is not None:
+                read_timeout = overrides.read
+            expires = min_timeout(expires, overrides.expires)
+
+        is_secure = self.is_secure
+        host = "%s:%d" % (server, self.port)
+        endpoint_key = self._endpoint_key(bucket)
+        endpoint = self.endpoints.get(endpoint_key)
+        if endpoint is not None:
+            is_secure, host = endpoint
+        redirected = False
+        attempts = 0
+        retryable = self.retry_policy.is_retryable(method, data)
+        position = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            position = data.tell()
+        while True:
+            final_headers = merge_meta(headers, metadata)
+            if 'Content-Length' not in final_headers:
+                if position is not None:
+                    data.seek(0, 2)
+                    final_headers['Content-Length'] = str(data.tell() - position)
+                    data.seek(position)
+                elif not hasattr(data, 'read'):
+                    final_headers['Content-Length'] = str(len(data or b''))
+            self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
+
+            attempts += 1
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve(bucket, method, key, expires)
+                if wait is None:
+                    raise DeadlineExceeded('The deadline for the request to S3 passed.')
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                resp = await asyncio.wait_for(
+                    self._send(is_secure, host, method, path, data,
+                               final_headers, connect_timeout, read_timeout),
+                    self._remaining(expires)
+                )
+            except DeadlineExceeded:
+                raise
+            except (OSError, httplib.HTTPException, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                self._remaining(expires)
+                if not retryable or not await self._retry(
+                        attempts, method, bucket, key, e, expires):
+                    raise
+                if position is not None:
+                    data.seek(position)
+                continue
+            if self.rate_limiter is not None:
+                if resp.status == 503:
+                    self.rate_limiter.throttled(bucket, method, key)
+                elif resp.status < 500:
+                    self.rate_limiter.succeeded(bucket, method, key)
+            if retryable and \
+               self.retry_policy.is_retryable_status(resp.status) and \
+               await self._retry(attempts, method, bucket, key, resp.status,
+                                 expires):
+                if position is not None:
+                    data.seek(position)
+                continue
+            if resp.status < 500:
+                self.retry_policy.succeeded()
+            location = None
+            if 300 <= resp.status < 400:
+                location = resp.getheader('location')
+            if not location:
+                if redirected:
+                    self.endpoints.set(endpoint_key, is_secure, host)
+                return resp
+            scheme, host, path, params, query, fragment \
+                    = urlparse.urlparse(location)
+            if scheme == "http":    is_secure = False
+            elif scheme == "https": is_secure = True
+            else: raise S3Exception("Not http/https: " + location)
+            if query: path += "?" + query
+            redirected = True
+
+    async def _retry(self, attempts, method, bucket, key, reason, expires=None):
+        delay = self.retry_policy.delay(attempts)
+        if expires is not None and time.time() + delay >= expires:
+            return False
+        if not self.retry_policy.should_retry(attempts):
+            return False
+        request_retried.send(
+            sender=self.__class__,
+            method=method,
+            bucket=bucket,
+            key=key,
+            attempt=attempts,
+            reason=reason
+        )
+        await asyncio.sleep(delay)
+        return True
+
+    async def _send(self, is_secure, host, method, path, data, headers,
+                    connect_timeout=None, read_timeout=None):
+        """
+        Sends the request over a pooled connection if there is one, falling
+        back to a fresh connection if the pooled one turns out to have been
+        closed by the server.
+        """
+        host_header = host
+        if host.endswith(':%d' % PORTS_BY_SECURITY[is_secure]):
+            host_header = host.rsplit(':', 1)[0]
+        position = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            position = data.tell()
+        async with self.pool.semaphore:
+            connection = self.pool.get(is_secure, host)
+            if connection is not None:
+                connection.read_timeout = read_timeout
+                try:
+                    await connection.request(method, host_header, path,
+                                             headers, data)
+                    resp = await connection.getresponse(method)
+                    self.pool.put(is_secure, host, connection)
+                    return resp
+                except asyncio.TimeoutError:
+                    connection.close()
+                    raise
+                except (OSError, httplib.HTTPException,
+                        asyncio.IncompleteReadError):
+                    connection.close()
+                    if position is None and hasattr(data, 'read'):
+                        raise
+                    if position is not None:
+                        data.seek(position)
+            connection = await self.pool.connect(
+                is_secure,
+                host,
+                self.ssl_context,
+                connect_timeout,
+                read_timeout
+            )
+            try:
+                await connection.request(method, host_header, path, headers,
+                                         data)
+                resp = await connection.getresponse(method)
+            except:
+                connection.close()
+                raise
+            self.pool.put(is_secure, host, connection)
+            return resp
+
+
+class AsyncStorageMixin(object):
+    """
+    Native async counterparts of S3Storage's methods which don't tie up a
+    thread for each request.
+    """
+
+    @property
+    def async_connection(self):
+        connection = getattr(self, '_async_connection', None)
+        if connection is None:
+            connection = AsyncAWSAuthConnection.from_connection(
+                self.connection
+            )
+            self._async_connection = connection
+        return connection
+
+    async def aopen(self, name, mode='rb'):
+        return self._open(name, mode)
+
+    async def asave(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = await self.aget_available_name(name, max_length=max_length)
+        await self._aput_file(name, content)
+        # Check the name is still valid as Storage.save does.
+        if validate_file_name is not None:
+            validate_file_name(name, allow_relative_path=True)
+        return name
+
+    async def aget_available_name(self, name, max_length=None):
+        # Storage.get_available_name also checks the name is safe and calls
+        # get_alternative_name, so it's used as it is in a thread instead of
+        # being copied here.
+        return await run_in_thread(self.get_available_name, name,
+                                   max_length=max_length)
+
+    async def _aput_file(self, name, content):
+        # Compressing and spooling the content, multipart uploads and the
+        # metadata cache all block, so only single PUTs are made on the loop.
+        threshold = self._multipart_threshold()
+        name, headers, content_to_send, content_length, file_pos, \
+            placeholder = await run_in_thread(self._prepare_put, name,
+                                              content, threshold)
+        if self._use_multipart(content_to_send, content_length, threshold):
+            response, content_length = await run_in_thread(
+                self._put_large,
+                name,
+                headers,
+                content_to_send,
+                content_length
+            )
+        else:
+            response = await self.async_connection.put(
+                self.bucket,
+                name,
+                content_to_send,
+                headers
+            )
+        await run_in_thread(self._finish_put, name, content, response,
+                            content_length, file_pos, placeholder)
+
+    async def _aread(self, name, start_range=None, end_range=None):
+        name = self._path(name)
+        response = await self.async_connection.get(
+            self.bucket,
+            name,
+            self._range_headers(start_range, end_range)
+        )
+        return self._read_response(response, start_range, end_range)
+
+    async def _acached_content(self, name):
+        # The content cache reads and writes files, so it's used in a thread.
+        path = self._path(name)
+        cached = await run_in_thread(self.content_cache.get,
+                                     self._content_key(path),
+                                     self._known_etag(path))
+        if cached is None or not self._revalidate_content():
+            return cached
+        response = await self.async_connection.get(
+            self.bucket,
+            path,
+            {'If-None-Match': cached[0]}
+        )
+        return await run_in_thread(self._revalidate_response, path, cached,
+                                   response, [response.object.data])
+
+    async def adelete(self, name):
+        name = self._path(name)
+        response = await self.async_connection.delete(self.bucket, name)
+        await self._acall_caching(self._delete_response, name, response)
+
+    async def _acall_caching(self, func, *args):
+        """
+        Calls one of the methods handling a response, in a thread if there's
+        a cache for it to update as the caches block.
+        """
+        if self.cache or self.content_cache:
+            return await run_in_thread(func, *args)
+        return func(*args)
+
+    async def _ahead(self, name, force_check=False):
+        memo = request_memo()
+        if memo is not None and not force_check:
+            response = memo.get(name)
+            if response is not None:
+                return response
+        response = await self.async_connection.head(self.bucket, name)
+        response = response.http_response
+        if memo is not None and response.status in (200, 404):
+            memo[name] = response
+        return response
+
+    async def aexists(self, name, force_check=False):
+        if not name:
+            return False
+        name = self._path(name)
+        if self.cache and not force_check:
+            exists = await run_in_thread(self.cache.exists, name)
+            if exists is not None:
+                return exists
+        response = await self._ahead(name, force_check)
+        return await self._acall_caching(self._exists_response, name,
+                                         response)
+
+    async def asize(self, name, force_check=False):
+        name = self._path(name)
+        if self.cache and not force_check:
+            size = await run_in_thread(self.cache.size, name)
+            if size is not None:
+                return size
+        response = await self._ahead(name, force_check)
+        return await self._acall_caching(self._size_response, name,
+                                         response)
+
+    async def amodified_time(self, name, force_check=False):
+        name = self._path(name)
+        if self.cache and not force_check:
+            last_modified = await run_in_thread(self.cache.modified_time, name)
+            if last_modified:
+                return datetime.fromtimestamp(last_modified)
+        response = await self._ahead(name, force_check)
+        return await self._acall_caching(self._modified_time_response, name,
+                                         response)
+
+    async def alistdir(self, path):
+        path, options = self._listdir_options(path)
+        response = await self.async_connection.list_bucket(
+            self.bucket,
+            options=options
+        )
+        return self._listdir_response(path, response)
+
+
+class AsyncStorageFileMixin(object):
+    """
+    Native async counterparts of S3StorageFile's methods.
+    """
+
+    async def asize(self):
+        if not hasattr(self, '_size'):
+            if await self._acached_content() is not None:
+                self._size = len(self._content)
+            elif self._gzip is not None:
+                self._size = await run_in_thread(self._gzip_size)
+            elif self._storage._may_be_gzipped(self.name):
+                response = await self._storage._ahead(
+                    self._storage._path(self.name)
+                )
+                # The decompressed size of a gzipped file is read from the
+                # end of it with a blocking request.
+                self._size = await run_in_thread(self._head_size, response)
+            else:
+                self._size = await self._storage.asize(self.name)
+        return self._size
+
+    async def _acached_content(self):
+        if self._storage.content_cache is not None and \
+           not self._is_dirty and not self._content_checked:
+            self._use_cached(
+                await self._storage._acached_content(self.name)
+            )
+        return self._cached_content()
+
+    async def aread(self, num_bytes=None):
+        if await self._acached_content() is not None:
+            return self._read_cached(num_bytes)
+        if self.start_range:
+            # Fetch the size now so _read_args doesn't have to block on it.
+            await self.asize()
+        if self._gzip is None:
+            args = self._read_args(num_bytes)
+            if args is None:
+                return self._empty_read()
+
+            try:
+                result = await self._storage._aread(self.name, *args)
+            except S3Error as e:
+                if '<Code>InvalidRange</Code>' in '%s' % e:
+                    return self._empty_read()
+                raise
+            if result is not None:
+                data, etags, content_range = result
+                if not args and self._storage.content_cache is not None:
+                    await run_in_thread(self._save_content, etags, data)
+                return self._read_result(data, content_range)
+        # Ranges of gzipped files are read through a GzipView of the
+        # decompressed stream as they are by read, which blocks.
+        return await run_in_thread(self._read_fetched, num_bytes)
+
+    async def aclose(self):
+        if self._is_dirty:
+            if self._upload is not None:
+                # The parts uploaded while writing used threads, so finish
+                # the upload with them too.
+                await run_in_thread(self._complete_upload)
+            else:
+                await self._storage._aput_file(self.name, self.file)
+            self._size = self._written
+            self._is_dirty = False
+        if self._gzip is not None:
+            self._gzip.close()
+        self._release_content()
+        self.file.close()
@@ -1,10 +1,59 @@
+import errno
 import hashlib
 import os
+import tempfile
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 from django.conf import settings
+try:
+    from django.core.cache import caches
+except ImportError: # Django < 1.7
+    from django.core.cache import get_cache
+
+    class _Caches(object):
+        def __getitem__(self, alias):
+            return get_cache(alias)
+
+    caches = _Caches()
+try:
+    from django.core.cache.backends.base import DEFAULT_TIMEOUT
+except ImportError: # Django < 1.6, where None means the default timeout
+    DEFAULT_TIMEOUT = None
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import force_text
 
 
+if hasattr(os, 'replace'):
+    _replace = os.replace
+else:
+    _replace = os.rename
+
+# Files written with mkstemp are only readable by their owner, so they're
+# given the permissions a new file would normally get instead, letting
+# processes run by other users share the cache.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def set_file_mode(fd):
+    if hasattr(os, 'fchmod'):
+        os.fchmod(fd, FILE_MODE)
+
+# How long in seconds to remember that a file doesn't exist.
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+
+
+def get_negative_ttl(negative_ttl=None):
+    if negative_ttl is None:
+        negative_ttl = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_NEGATIVE_CACHE_TTL', DEFAULT_NEGATIVE_CACHE_TTL)
+    return negative_ttl
+
+
 class Cache(object):
     """
     A base cache class, providing some default behaviors that all other
@@ -20,6 +69,15 @@ class Cache(object):
         """
         raise NotImplementedError()
 
+    def save_missing(self, name):
+        """
+        Remembers that name doesn't exist, so that exists returns False for
+        it until the entry expires or values are saved for it.
+
+        Caches that don't support this can leave it as it is.
+        """
+        pass
+
     def size(self, name):
         """
         Returns the total size, in bytes, of the file specified by name.
@@ -49,9 +107,248 @@ class Cache(object):
         """
         raise NotImplementedError()
 
+    def get(self, name):
+        """
+        Returns a dict of the cached values, ``size`` and ``mtime``, or None
+        if they aren't cached. Caches that can look them up together should
+        override this.
+        """
+        size = self.size(name)
+        mtime = self.modified_time(name)
+        if size is None or mtime is None:
+            return None
+        return {'size': size, 'mtime': mtime}
+
+    def get_many(self, names):
+        """
+        Returns a dict of names to the dicts returned by ``get`` for each of
+        names that is cached, and to None for each the cache knows doesn't
+        exist. Caches that can look up several names at once should override
+        this and ``save_many``, ``save_missing_many`` and ``remove_many``.
+        """
+        found = {}
+        for name in names:
+            values = self.get(name)
+            if values is not None:
+                found[name] = values
+            elif self.exists(name) is False:
+                found[name] = None
+        return found
+
+    def save_many(self, values):
+        """
+        Saves a dict of names to dicts of ``size`` and ``mtime``.
+        """
+        for name, v in values.items():
+            self.save(name, v['size'], v['mtime'])
+
+    def save_missing_many(self, names):
+        for name in names:
+            self.save_missing(name)
+
+    def remove_many(self, names):
+        for name in names:
+            self.remove(name)
+
+
+DEFAULT_MEMORY_CACHE_SIZE = 10000
+DEFAULT_MEMORY_CACHE_TIMEOUT = 60
+
+
+class MemoryCache(Cache):
+    """
+    Keeps the metadata of up to ``max_entries`` files in memory for
+    ``timeout`` seconds, dropping the least recently used when it's full.
+    Files that don't exist are remembered for ``negative_ttl`` seconds.
+
+    Being local to the process it doesn't see changes made by other
+    processes, so it's best used with a short timeout in front of a shared
+    cache with ``ChainCache``.
+    """
+
+    def __init__(self, max_entries=None, timeout=None, negative_ttl=None):
+        if max_entries is None:
+            max_entries = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_SIZE', DEFAULT_MEMORY_CACHE_SIZE)
+        if timeout is None:
+            timeout = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_TIMEOUT', DEFAULT_MEMORY_CACHE_TIMEOUT)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.negative_ttl = get_negative_ttl(negative_ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] <= time.time():
+                return None
+            self._entries[name] = entry
+            return entry
+
+    def get(self, name):
+        entry = self._get(name)
+        if entry is None or entry[0] is None:
+            return None
+        return {'size': entry[0], 'mtime': entry[1]}
+
+    def exists(self, name):
+        entry = self._get(name)
+        if entry is None:
+            return None
+        # Files that don't exist are stored without a size
+        return entry[0] is not None
+
+    def get_many(self, names):
+        found = {}
+        for name in names:
+            entry = self._get(name)
+            if entry is None:
+                continue
+            if entry[0] is None:
+                found[name] = None
+            else:
+                found[name] = {'size': entry[0], 'mtime': entry[1]}
+        return found
+
+    def size(self, name):
+        entry = self._get(name)
+        return entry and entry[0]
+
+    def modified_time(self, name):
+        entry = self._get(name)
+        return entry and entry[1]
+
+    def save(self, name, size, mtime):
+        expires = None
+        if self.timeout is not None:
+            expires = time.time() + self.timeout
+        self._set(name, (size, mtime, expires))
+
+    def save_missing(self, name):
+        if not self.negative_ttl:
+            return
+        ttl = self.negative_ttl
+        if self.timeout is not None:
+            ttl = min(ttl, self.timeout)
+        self._set(name, (None, None, time.time() + ttl))
+
+    def _set(self, name, entry):
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+class ChainCache(Cache):
+    """
+    Looks up metadata in each of ``caches`` in turn, such as a MemoryCache
+    in front of a FileSystemCache, copying it to the caches before the one
+    it was found in. Saves and removals go to all of them.
+
+    Setting ``CUDDLYBUDDLY_STORAGE_S3_CACHE`` to a list of cache classes
+    uses this.
+    """
+
+    def __init__(self, caches):
+        self.caches = list(caches)
+
+    def _lookup(self, name, method):
+        for i, cache in enumerate(self.caches):
+            value = getattr(cache, method)(name)
+            if value is False:
+                for earlier in self.caches[:i]:
+                    earlier.save_missing(name)
+            elif value is not None and i:
+                self._fill(name, cache.get(name), self.caches[:i])
+            if value is not None:
+                return value
+        return None
+
+    def _fill(self, name, values, caches):
+        if values is not None:
+            for earlier in caches:
+                earlier.save(name, values['size'], values['mtime'])
+
+    def get(self, name):
+        for i, cache in enumerate(self.caches):
+            values = cache.get(name)
+            if values is not None:
+                self._fill(name, values, self.caches[:i])
+                return values
+        return None
+
+    def exists(self, name):
+        return self._lookup(name, 'exists')
+
+    def size(self, name):
+        return self._lookup(name, 'size')
+
+    def modified_time(self, name):
+        return self._lookup(name, 'modified_time')
+
+    def save(self, name, size, mtime):
+        for cache in self.caches:
+            cache.save(name, size, mtime)
+
+    def save_missing(self, name):
+        for cache in self.caches:
+            cache.save_missing(name)
+
+    def get_many(self, names):
+        found = {}
+        remaining = list(names)
+        for i, cache in enumerate(self.caches):
+            if not remaining:
+                break
+            values = cache.get_many(remaining)
+            if values:
+                cached = dict((name, v) for name, v in values.items()
+                              if v is not None)
+                missing = [name for name, v in values.items() if v is None]
+                for earlier in self.caches[:i]:
+                    if cached:
+                        earlier.save_many(cached)
+                    if missing:
+                        earlier.save_missing_many(missing)
+                found.update(values)
+                remaining = [name for name in remaining if name not in values]
+        return found
+
+    def save_many(self, values):
+        for cache in self.caches:
+            cache.save_many(values)
+
+    def save_missing_many(self, names):
+        for cache in self.caches:
+            cache.save_missing_many(names)
+
+    def remove_many(self, names):
+        for cache in self.caches:
+            cache.remove_many(names)
+
+    def remove(self, name):
+        for cache in self.caches:
+            cache.remove(name)
+
 
 class FileSystemCache(Cache):
-    def __init__(self, cache_dir=None):
+    """
+    Stores each file's metadata in a small file on the local disk, so it can
+    be shared by all the processes on a server.
+
+    Records are spread over two levels of subdirectories so no directory
+    gets too large and are written to a temporary file that is renamed into
+    place, so a record is never read while it's only partly written.
+    """
+
+    def __init__(self, cache_dir=None, negative_ttl=None):
         if cache_dir is None:
             cache_dir = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_FILE_CACHE_DIR', None)
             if cache_dir is None:
@@ -59,40 +356,216 @@ class FileSystemCache(Cache):
                     '%s requires CUDDLYBUDDLY_STORAGE_S3_FILE_CACHE_DIR to be set to a directory.' % type(self)
                 )
         self.cache_dir = cache_dir
+        self.negative_ttl = get_negative_ttl(negative_ttl)
 
     def _path(self, name):
         name = force_text(name).encode('utf-8')
-        return os.path.join(self.cache_dir, hashlib.md5(name).hexdigest())
+        digest = hashlib.md5(name).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:4], digest)
+
+    def _read(self, name):
+        """
+        Returns the size and mtime from the record for name, or None and when
+        the record expires for files that don't exist, or None if there's no
+        current record.
+        """
+        # A record is "size mtime\nname", or "- expires\nname".
+        try:
+            with open(self._path(name), 'rb') as file_:
+                record = file_.read()
+        except (IOError, OSError):
+            return None
+        try:
+            values, cached_name = record.split(b'\n', 1)
+            size, mtime = values.split(b' ')
+            if cached_name.decode('utf-8') != force_text(name):
+                return None
+            if size == b'-':
+                if float(mtime) <= time.time():
+                    return None
+                return None, float(mtime)
+            return int(size), float(mtime)
+        except ValueError:
+            # Not a record written by this version.
+            return None
+
+    def get(self, name):
+        values = self._read(name)
+        if values is None or values[0] is None:
+            return None
+        return {'size': values[0], 'mtime': values[1]}
 
     def exists(self, name):
-        return None
+        values = self._read(name)
+        if values is None:
+            return None
+        return values[0] is not None
+
+    def get_many(self, names):
+        found = {}
+        for name in names:
+            values = self._read(name)
+            if values is None:
+                continue
+            if values[0] is None:
+                found[name] = None
+            else:
+                found[name] = {'size': values[0], 'mtime': values[1]}
+        return found
 
     def size(self, name):
-        try:
-            file = open(self._path(name))
-            size = int(file.readlines()[1])
-            file.close()
-        except:
-            size = None
-        return size
+        values = self.get(name)
+        return values and values['size']
 
     def modified_time(self, name):
+        values = self.get(name)
+        return values and values['mtime']
+
+    def save(self, name, size, mtime):
+        self._write(name, '%d %r' % (int(size), float(mtime)))
+
+    def save_missing(self, name):
+        if self.negative_ttl:
+            self._write(name, '- %r' % (time.time() + self.negative_ttl))
+
+    def _write(self, name, values):
+        path = self._path(name)
+        directory = os.path.dirname(path)
         try:
-            file = open(self._path(name))
-            mtime = float(file.readlines()[2])
-            file.close()
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Only create the directory when it turns out to be missing.
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=directory)
+        try:
+            set_file_mode(fd)
+            with os.fdopen(fd, 'wb') as file_:
+                file_.write(('%s\n%s' % (values, force_text(name))).encode('utf-8'))
+            _replace(tmp_path, path)
         except:
-            mtime = None
-        return mtime
+            os.remove(tmp_path)
+            raise
+
+    def remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class DjangoCache(Cache):
+    """
+    Stores metadata in one of Django's caches, ``alias`` defaulting to
+    ``CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE``, so a cache such as memcached or
+    redis can be shared by all the servers of a site.
+
+    Values are stored as a short string of the size and mtime, or ``-`` for
+    files that don't exist, under a hash of the name so the key is always
+    valid for memcached.
+    """
+
+    def __init__(self, alias=None, timeout=DEFAULT_TIMEOUT, negative_ttl=None):
+        if alias is None:
+            alias = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE', 'default')
+        if timeout is DEFAULT_TIMEOUT:
+            # The timeout of the cache in CACHES unless it's overridden, None
+            # keeps entries until they're evicted.
+            timeout = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+        self.alias = alias
+        self.timeout = timeout
+        self.negative_ttl = get_negative_ttl(negative_ttl)
+
+    @property
+    def cache(self):
+        # Django's caches are per thread so they're looked up each time.
+        return caches[self.alias]
+
+    def _key(self, name):
+        name = force_text(name).encode('utf-8')
+        return 'cbs3:%s' % hashlib.md5(name).hexdigest()
+
+    def _decode(self, value):
+        """
+        Returns the size and mtime from a value, None and None for files that
+        don't exist, or None for values that aren't cached.
+        """
+        if value is None:
+            return None
+        if value == '-':
+            return None, None
+        try:
+            size, mtime = value.split(' ')
+            return int(size), float(mtime)
+        except ValueError:
+            return None
+
+    def _encode(self, size, mtime):
+        return '%d %r' % (int(size), float(mtime))
+
+    def get(self, name):
+        values = self._decode(self.cache.get(self._key(name)))
+        if values is None or values[0] is None:
+            return None
+        return {'size': values[0], 'mtime': values[1]}
+
+    def exists(self, name):
+        values = self._decode(self.cache.get(self._key(name)))
+        if values is None:
+            return None
+        return values[0] is not None
+
+    def size(self, name):
+        values = self.get(name)
+        return values and values['size']
+
+    def modified_time(self, name):
+        values = self.get(name)
+        return values and values['mtime']
 
     def save(self, name, size, mtime):
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-        file = open(self._path(name), 'wb')
-        file.write(('%s\n%s\n%s' % (name, size, mtime)).encode('utf-8'))
-        file.close()
+        self.cache.set(self._key(name), self._encode(size, mtime),
+                       self.timeout)
+
+    def save_missing(self, name):
+        if self.negative_ttl:
+            self.cache.set(self._key(name), '-', self.negative_ttl)
 
     def remove(self, name):
-        name = self._path(name)
-        if os.path.exists(name):
-            os.remove(name)
+        self.cache.delete(self._key(name))
+
+    def get_many(self, names):
+        keys = dict((self._key(name), name) for name in names)
+        found = {}
+        for key, value in self.cache.get_many(list(keys)).items():
+            values = self._decode(value)
+            if values is None:
+                continue
+            if values[0] is None:
+                found[keys[key]] = None
+            else:
+                found[keys[key]] = {'size': values[0], 'mtime': values[1]}
+        return found
+
+    def save_many(self, values):
+        self.cache.set_many(
+            dict((self._key(name), self._encode(v['size'], v['mtime']))
+                 for name, v in values.items()),
+            self.timeout
+        )
+
+    def save_missing_many(self, names):
+        if self.negative_ttl:
+            self.cache.set_many(
+                dict((self._key(name), '-') for name in names),
+                self.negative_ttl
+            )
+
+    def remove_many(self, names):
+        self.cache.delete_many([self._key(name) for name in names])
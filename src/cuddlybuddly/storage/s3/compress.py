@@ -0,0 +1,245 @@
+from bisect import bisect_right
+import threading
+import zlib
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_LEVEL = 9
+# Content types which have compressed to less than this ratio of their size
+# are gzipped without sampling them first.
+CONFIDENT_RATIO = 0.9
+DEFAULT_CHECKPOINT_INTERVAL = 1024 * 1024
+DEFAULT_MAX_CHECKPOINTS = 64
+
+
+class GzipStream(object):
+    """
+    A read only file like object returning the gzipped contents of
+    ``fileobj``, compressing it a chunk at a time as it's read so that it
+    never has to be held in memory.
+
+    ``raw_length`` and ``length`` are the number of bytes read from
+    ``fileobj`` and returned so far and ``size`` is the length of ``fileobj``
+    if it's known.
+    """
+
+    def __init__(self, fileobj, size=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 level=COMPRESSION_LEVEL):
+        self.fileobj = fileobj
+        self.size = size
+        self.chunk_size = chunk_size
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+        self._buffer = bytearray()
+        self._eof = False
+        self.raw_length = 0
+        self.length = 0
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self.fileobj.read(self.chunk_size)
+            if data:
+                self.raw_length += len(data)
+                self._buffer.extend(self._compressor.compress(data))
+            else:
+                self._buffer.extend(self._compressor.flush())
+                self._eof = True
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.length += len(data)
+        return data
+
+
+def gzipped_length(data, level=COMPRESSION_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return len(compressor.compress(data)) + len(compressor.flush())
+
+
+class CompressionHistory(object):
+    """
+    Remembers how well each content type has compressed, as a moving
+    average of the ratio of gzipped to original sizes.
+    """
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self._ratios = {}
+        self._lock = threading.Lock()
+
+    def record(self, content_type, length, gzipped_length):
+        if not length:
+            return
+        ratio = float(gzipped_length) / length
+        with self._lock:
+            previous = self._ratios.get(content_type)
+            if previous is not None:
+                ratio = previous + self.weight * (ratio - previous)
+            self._ratios[content_type] = ratio
+
+    def ratio(self, content_type):
+        with self._lock:
+            return self._ratios.get(content_type)
+
+
+default_history = CompressionHistory()
+
+
+def should_gzip(content, content_type, history=None,
+                sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Returns True if gzipping ``content`` is likely to make it smaller, going
+    by how well ``content_type`` has compressed before or else by
+    compressing the first ``sample_size`` bytes of it.
+    """
+    if history is None:
+        history = default_history
+    ratio = history.ratio(content_type)
+    if ratio is not None and ratio < CONFIDENT_RATIO:
+        return True
+    pos = content.tell()
+    sample = content.read(sample_size)
+    content.seek(pos)
+    return gzipped_length(sample) < len(sample)
+
+
+def gunzip_chunks(chunks):
+    """
+    Decompresses an iterable of gzipped chunks a chunk at a time.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class _Cursor(object):
+    def __init__(self, raw_offset, offset, decompressor, chunks):
+        self.raw_offset = raw_offset
+        self.offset = offset
+        self.decompressor = decompressor
+        self.chunks = chunks
+        self.pending = b''
+        self.eof = False
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class GzipView(object):
+    """
+    Random access to the decompressed contents of a gzipped file, given
+    ``stream(offset)`` which returns an iterable of its bytes from
+    ``offset`` to the end.
+
+    A copy of the decompressor is kept every ``interval`` decompressed bytes
+    so reads only have to decompress from the nearest copy before them
+    instead of from the start. Sequential reads carry on from where the last
+    one stopped. Once there are ``max_checkpoints`` copies every other one is
+    dropped and the interval doubled.
+
+    ``size`` is the decompressed size once the end has been reached.
+    """
+
+    def __init__(self, stream, interval=DEFAULT_CHECKPOINT_INTERVAL,
+                 max_checkpoints=DEFAULT_MAX_CHECKPOINTS):
+        self.stream = stream
+        self.interval = interval
+        self.max_checkpoints = max_checkpoints
+        self.size = None
+        self._checkpoints = [(0, 0, zlib.decompressobj(16 + zlib.MAX_WBITS))]
+        self._cursor = None
+        self._lock = threading.Lock()
+
+    def read(self, start, end=None):
+        """
+        Returns the decompressed bytes between the inclusive offsets
+        ``start`` and ``end``, or to the end if ``end`` is None.
+        """
+        with self._lock:
+            return self._read(start, end)
+
+    def close(self):
+        with self._lock:
+            self._close_cursor()
+
+    def _read(self, start, end):
+        if self.size is not None:
+            if end is None or end >= self.size:
+                end = self.size - 1
+            if start > end:
+                return b''
+        checkpoint = self._checkpoints[
+            bisect_right([c[0] for c in self._checkpoints], start) - 1
+        ]
+        cursor = self._cursor
+        if cursor is None or cursor.raw_offset > start or \
+           cursor.raw_offset < checkpoint[0]:
+            self._close_cursor()
+            raw_offset, offset, decompressor = checkpoint
+            cursor = _Cursor(raw_offset, offset, decompressor.copy(),
+                             iter(self.stream(offset)))
+            self._cursor = cursor
+        data = []
+        while end is None or cursor.raw_offset <= end:
+            chunk = cursor.pending or self._advance(cursor)
+            cursor.pending = b''
+            if chunk is None:
+                break
+            skip = max(start - cursor.raw_offset, 0)
+            if end is None or end + 1 - cursor.raw_offset >= len(chunk):
+                if skip < len(chunk):
+                    data.append(chunk[skip:])
+                cursor.raw_offset += len(chunk)
+            else:
+                keep = end + 1 - cursor.raw_offset
+                data.append(chunk[skip:keep])
+                cursor.pending = chunk[keep:]
+                cursor.raw_offset += keep
+        return b''.join(data)
+
+    def _advance(self, cursor):
+        """
+        Returns the next decompressed chunk or None at the end.
+        """
+        if cursor.eof:
+            return None
+        decompressor = cursor.decompressor
+        for chunk in cursor.chunks:
+            cursor.offset += len(chunk)
+            data = decompressor.decompress(chunk)
+            if decompressor.unused_data or getattr(decompressor, 'eof', False):
+                break
+            raw_offset = cursor.raw_offset + len(data)
+            if raw_offset >= self._checkpoints[-1][0] + self.interval:
+                self._add_checkpoint(raw_offset, cursor.offset,
+                                     decompressor.copy())
+            return data
+        else:
+            data = b''
+        data += decompressor.flush()
+        cursor.eof = True
+        cursor.close()
+        self.size = cursor.raw_offset + len(data)
+        return data
+
+    def _add_checkpoint(self, raw_offset, offset, decompressor):
+        self._checkpoints.append((raw_offset, offset, decompressor))
+        if len(self._checkpoints) > self.max_checkpoints:
+            self._checkpoints = self._checkpoints[::2]
+            self.interval *= 2
+
+    def _close_cursor(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
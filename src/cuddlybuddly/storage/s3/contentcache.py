@@ -0,0 +1,189 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_text
+from cuddlybuddly.storage.s3.cache import set_file_mode
+
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# Only files up to this size are cached, larger ones are read from S3.
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+
+if hasattr(os, 'replace'):
+    _replace = os.replace
+else:
+    _replace = os.rename
+
+
+class ContentCache(object):
+    """
+    Keeps the contents of small files on the local disk, along with the ETag
+    of the version that was cached, so they can be read without a request to
+    S3.
+
+    Once the cached files total more than ``max_size`` bytes the least
+    recently used are removed. Files are written to a temporary file and
+    renamed into place so other processes sharing ``cache_dir`` never read a
+    partly written file. If ``use_mmap`` is True cached contents are returned
+    as a memoryview of a memory mapped file instead of being read into
+    memory. The mapping stays open for as long as the memoryview is
+    referenced, so callers should drop it once they're done. Removing or
+    evicting the file meanwhile only unlinks it, and the mapping keeps its
+    contents until it's closed.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None, max_file_size=None,
+                 use_mmap=None):
+        if cache_dir is None:
+            cache_dir = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_DIR', None)
+            if cache_dir is None:
+                raise ImproperlyConfigured(
+                    '%s requires CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_DIR to be set to a directory.' % type(self)
+                )
+        if max_size is None:
+            max_size = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_SIZE', DEFAULT_MAX_SIZE)
+        if max_file_size is None:
+            max_file_size = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_MAX_FILE_SIZE', DEFAULT_MAX_FILE_SIZE)
+        if use_mmap is None:
+            use_mmap = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_MMAP', False)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.use_mmap = use_mmap
+        self._lock = threading.Lock()
+        self._entries = None
+        self._total = 0
+
+    def _path(self, name):
+        digest = hashlib.md5(force_text(name).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _load(self):
+        """
+        Builds the index of cached files from the cache directory, oldest
+        first, as other processes may have filled it.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict()
+        self._total = 0
+        for mtime, path, size in entries:
+            self._entries[path] = size
+            self._total += size
+
+    def _index(self):
+        if self._entries is None:
+            self._load()
+        return self._entries
+
+    def get(self, name, etag=None):
+        """
+        Returns a tuple of the ETag and contents of name, or None if it isn't
+        cached or if a different ``etag`` is given.
+        """
+        path = self._path(name)
+        try:
+            with open(path, 'rb') as file_:
+                header = file_.readline()
+                if self.use_mmap:
+                    size = os.fstat(file_.fileno()).st_size
+                    if size > len(header):
+                        data = memoryview(mmap.mmap(
+                            file_.fileno(), 0, access=mmap.ACCESS_READ
+                        ))[len(header):]
+                    else:
+                        data = b''
+                else:
+                    data = file_.read()
+        except (IOError, OSError):
+            return None
+        cached_etag = header[:-1].decode('utf-8')
+        if etag is not None and etag != cached_etag:
+            return None
+        with self._lock:
+            entries = self._index()
+            size = entries.pop(path, None)
+            if size is None:
+                size = len(header) + len(data)
+                self._total += size
+            entries[path] = size
+        try:
+            # Keep the order of use for other processes and restarts.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return cached_etag, data
+
+    def save(self, name, etag, data):
+        """
+        Saves the contents of name, returning False if it's too large or
+        couldn't be written.
+        """
+        if len(data) > self.max_file_size:
+            return False
+        path = self._path(name)
+        directory = os.path.dirname(path)
+        header = ('%s\n' % etag).encode('utf-8')
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=directory)
+            try:
+                set_file_mode(fd)
+                with os.fdopen(fd, 'wb') as file_:
+                    file_.write(header)
+                    file_.write(data)
+                _replace(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            # Caching is only an optimisation so failing to write to it, such
+            # as when the disk is full, shouldn't fail the read.
+            return False
+        with self._lock:
+            entries = self._index()
+            self._total -= entries.pop(path, 0)
+            entries[path] = len(header) + len(data)
+            self._total += entries[path]
+            evicted = []
+            while self._total > self.max_size and len(entries) > 1:
+                old_path, size = entries.popitem(last=False)
+                self._total -= size
+                evicted.append(old_path)
+        for old_path in evicted:
+            self._remove_path(old_path)
+        return True
+
+    def remove(self, name):
+        path = self._path(name)
+        with self._lock:
+            if self._entries is not None:
+                self._total -= self._entries.pop(path, 0)
+        self._remove_path(path)
+
+    def _remove_path(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Another process has already removed it.
+            pass
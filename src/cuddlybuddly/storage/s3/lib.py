@@ -26,31 +26,144 @@
 #
 #  2014/07/26 - Python 3 support
 #
+#  Connections are kept alive and reused through a shared ConnectionPool.
+#
+#  HTTPS connections share one SSLContext and resume cached TLS sessions.
+#
+#  Redirected endpoints are cached per bucket and the inverted security of
+#  redirects has been fixed.
+#
+#  Failed requests are retried according to a RetryPolicy.
+#
+#  Connect and read timeouts and deadlines for each request, which can be
+#  overridden using Timeouts.
+#
+#  Requests can be limited by an AdaptiveRateLimiter.
+#
+#  Timeouts are stored in a context variable where available so they work
+#  with asyncio.
+#
+#  Added get_stream for reading objects in chunks.
+#
+#  Added the multipart upload requests.
+#
 #  (c) 2009-2011 Kyle MacFarlane
 
 import base64
+try:
+    from contextvars import ContextVar # Python 3.7
+except ImportError:
+    ContextVar = None
 import hmac
 try:
     import http.client as httplib # Python 3
 except ImportError:
     import httplib # Python 2
 import hashlib
+import socket
+import threading
 import time
 try:
     from urllib import parse as urlparse # Python 3
 except ImportError:
     import urlparse # Python 2
 import xml.sax
+from xml.sax.saxutils import escape as xml_escape
 from django.utils.http import urlquote
+from cuddlybuddly.storage.s3.pool import HTTPSConnection, TLSSessionCache, \
+    create_ssl_context, get_default_pool
+from cuddlybuddly.storage.s3.retry import RetryPolicy
+from cuddlybuddly.storage.s3.signals import request_retried
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 METADATA_PREFIX = 'x-amz-meta-'
 AMAZON_HEADER_PREFIX = 'x-amz-'
+# query string arguments which are part of the signed resource
+SUBRESOURCES = ('acl', 'location', 'logging', 'partNumber', 'torrent',
+                'uploadId', 'uploads')
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
 
 class S3Exception(Exception):
     pass
 
+class DeadlineExceeded(S3Exception, socket.timeout):
+    pass
+
+if ContextVar is not None:
+    _timeouts = ContextVar('cb_s3_timeouts', default=None)
+
+    def current_timeouts():
+        return _timeouts.get()
+
+    def _set_timeouts(timeouts):
+        _timeouts.set(timeouts)
+else:
+    _timeouts = threading.local()
+
+    def current_timeouts():
+        return getattr(_timeouts, 'current', None)
+
+    def _set_timeouts(timeouts):
+        _timeouts.current = timeouts
+
+class Timeouts:
+    """
+    Overrides the timeouts of requests made by the current thread within a
+    with block::
+
+        with Timeouts(deadline=2):
+            storage.size(name)
+
+    ``connect`` and ``read`` are socket timeouts in seconds and ``deadline`` is
+    the total number of seconds the block can spend on each request,
+    including retries and redirects. Nested deadlines never extend the
+    deadline of an enclosing block.
+    """
+    def __init__(self, deadline=None, connect=None, read=None):
+        self.deadline = deadline
+        self.connect = connect
+        self.read = read
+        self.expires = None
+
+    def __enter__(self):
+        parent = current_timeouts()
+        if self.deadline is not None:
+            self.expires = time.time() + self.deadline
+        if parent is not None:
+            if self.connect is None:
+                self.connect = parent.connect
+            if self.read is None:
+                self.read = parent.read
+            if parent.expires is not None and \
+               (self.expires is None or parent.expires < self.expires):
+                self.expires = parent.expires
+        _set_timeouts(self)
+        self._parent = parent
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _set_timeouts(self._parent)
+
+def call_with_timeouts(timeouts, func, *args, **kwargs):
+    """
+    Calls func with the Timeouts returned by current_timeouts() in another
+    thread so that work handed off to a thread pool keeps to them.
+    """
+    _set_timeouts(timeouts)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _set_timeouts(None)
+
+def min_timeout(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    if timeouts:
+        return min(timeouts)
+    return None
+
 # generates the aws canonical string for the given parameters
 def canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
     interesting_headers = {}
@@ -91,16 +204,17 @@ def canonical_string(method, bucket="", key="", query_args={}, headers={}, expir
     # add the key.  even if it doesn't exist, add the slash
     buf += "/%s" % urlquote(key, '/')
 
-    # handle special query string arguments
-
-    if "acl" in query_args:
-        buf += "?acl"
-    elif "torrent" in query_args:
-        buf += "?torrent"
-    elif "logging" in query_args:
-        buf += "?logging"
-    elif "location" in query_args:
-        buf += "?location"
+    # handle special query string arguments, which have to be sorted
+    subresources = [k for k in query_args if k in SUBRESOURCES]
+    subresources.sort()
+    pairs = []
+    for k in subresources:
+        if query_args[k] is None:
+            pairs.append(k)
+        else:
+            pairs.append("%s=%s" % (k, query_args[k]))
+    if pairs:
+        buf += "?" + "&".join(pairs)
 
     return buf
 
@@ -141,6 +255,36 @@ def query_args_hash_to_string(query_args):
     return '&'.join(pairs)
 
 
+def build_host(bucket, server, calling_format):
+    if bucket == '':
+        return server
+    elif calling_format == CallingFormat.SUBDOMAIN:
+        return "%s.%s" % (bucket, server)
+    elif calling_format == CallingFormat.VANITY:
+        return bucket
+    else:
+        return server
+
+def build_path(bucket, key, query_args, calling_format):
+    path = ''
+
+    if (bucket != '') and (calling_format == CallingFormat.PATH):
+        path += "/%s" % bucket
+
+    # add the slash after the bucket regardless
+    # the key will be appended if it is non-empty
+    path += "/%s" % urlquote(key, '/')
+
+
+    # build the path_argument string
+    # add the ? in all cases since 
+    # signature and credentials follow path args
+    if len(query_args):
+        path += "?" + query_args_hash_to_string(query_args)
+
+    return path
+
+
 class CallingFormat:
     PATH = 1
     SUBDOMAIN = 2
@@ -174,14 +318,69 @@ class Location:
     DEFAULT = None
     EU = 'EU'
 
+    def endpoint(location):
+        """
+        Returns the S3 endpoint for a location constraint as returned by
+        get_bucket_location.
+        """
+        if not location:
+            return DEFAULT_HOST
+        if location == Location.EU:
+            location = 'eu-west-1'
+        return 's3.%s.amazonaws.com' % location
+
+    endpoint = staticmethod(endpoint)
+
+
+class EndpointCache:
+    """
+    Remembers where requests for each bucket were redirected to so that later
+    requests can go straight there.
+    """
+    DEFAULT_TTL = 3600
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def get(self, key):
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                return None
+            if endpoint[2] < time.time():
+                del self._endpoints[key]
+                return None
+            return endpoint[:2]
+
+    def set(self, key, is_secure, host):
+        with self._lock:
+            self._endpoints[key] = (is_secure, host, time.time() + self.ttl)
+
+    def remove(self, key):
+        with self._lock:
+            self._endpoints.pop(key, None)
+
 
 
 class AWSAuthConnection:
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN,
+            pool=None, ssl_context=None, endpoint_ttl=EndpointCache.DEFAULT_TTL,
+            resolve_location=False, retry_policy=None,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT, deadline=None,
+            rate_limiter=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
+        if pool is None:
+            pool = get_default_pool()
+        if ssl_context is None:
+            ssl_context = create_ssl_context()
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
 
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
@@ -189,6 +388,17 @@ class AWSAuthConnection:
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        self.pool = pool
+        self.ssl_context = ssl_context
+        self.tls_sessions = TLSSessionCache()
+        self.endpoints = EndpointCache(endpoint_ttl)
+        self.resolve_location = resolve_location
+        self._resolved = set()
+        self.retry_policy = retry_policy
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.rate_limiter = rate_limiter
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -229,10 +439,51 @@ class AWSAuthConnection:
         return GetResponse(
                 self._make_request('GET', bucket, key, {}, headers))
 
+    def get_stream(self, bucket, key, headers={}):
+        return StreamingGetResponse(
+                self._make_request('GET', bucket, key, {}, headers))
+
     def delete(self, bucket, key, headers={}):
         return Response(
                 self._make_request('DELETE', bucket, key, {}, headers))
 
+    def initiate_multipart_upload(self, bucket, key, headers={}):
+        return InitiateMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploads': None }, headers))
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        return Response(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    headers,
+                    data))
+
+    def complete_multipart_upload(self, bucket, key, upload_id, etags, headers={}):
+        """
+        Completes an upload from the ETags of its parts, in order starting
+        with part 1.
+        """
+        body = "<CompleteMultipartUpload>"
+        for part_number, etag in enumerate(etags):
+            body += "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" \
+                    % (part_number + 1, xml_escape(etag))
+        body += "</CompleteMultipartUpload>"
+        return CompleteMultipartUploadResponse(
+                self._make_request(
+                    'POST',
+                    bucket,
+                    key,
+                    { 'uploadId': upload_id },
+                    headers,
+                    body.encode('utf-8')))
+
+    def abort_multipart_upload(self, bucket, key, upload_id, headers={}):
+        return Response(
+                self._make_request('DELETE', bucket, key, { 'uploadId': upload_id }, headers))
+
     def get_bucket_logging(self, bucket, headers={}):
         return GetResponse(self._make_request('GET', bucket, '', { 'logging': None }, headers))
 
@@ -265,65 +516,205 @@ class AWSAuthConnection:
     def get_bucket_location(self, bucket):
         return LocationResponse(self._make_request('GET', bucket, '', {'location' : None}))
 
-    # end public methods
-
-    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
-        server = ''
-        if bucket == '':
-            server = self.server
-        elif self.calling_format == CallingFormat.SUBDOMAIN:
-            server = "%s.%s" % (bucket, self.server)
-        elif self.calling_format == CallingFormat.VANITY:
-            server = bucket
-        else:
-            server = self.server
+    def prime_endpoint(self, bucket):
+        """
+        Looks up the location of the bucket and caches its regional endpoint
+        so that requests don't have to be redirected there first.
+        """
+        if self.server != DEFAULT_HOST:
+            return
+        response = self.get_bucket_location(bucket)
+        if response.http_response.status >= 300:
+            return
+        server = self._server(bucket, Location.endpoint(response.location))
+        key = self._endpoint_key(bucket)
+        self.endpoints.set(key, key[0], "%s:%d" % (server, self.port))
 
-        path = ''
-
-        if (bucket != '') and (self.calling_format == CallingFormat.PATH):
-            path += "/%s" % bucket
+    # end public methods
 
-        # add the slash after the bucket regardless
-        # the key will be appended if it is non-empty
-        path += "/%s" % urlquote(key, '/')
+    def _server(self, bucket, server):
+        return build_host(bucket, server, self.calling_format)
 
+    def _endpoint_key(self, bucket):
+        return (self.is_secure, self.server, self.port, self.calling_format, bucket)
 
-        # build the path_argument string
-        # add the ? in all cases since 
-        # signature and credentials follow path args
-        if len(query_args):
-            path += "?" + query_args_hash_to_string(query_args)
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        server = self._server(bucket, self.server)
+        path = build_path(bucket, key, query_args, self.calling_format)
+
+        if self.resolve_location and bucket and \
+           bucket not in self._resolved and 'location' not in query_args:
+            self._resolved.add(bucket)
+            try:
+                self.prime_endpoint(bucket)
+            except (socket.error, httplib.HTTPException, xml.sax.SAXException):
+                pass
+
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        expires = None
+        if self.deadline is not None:
+            expires = time.time() + self.deadline
+        overrides = current_timeouts()
+        if overrides is not None:
+            if overrides.connect is not None:
+                connect_timeout = overrides.connect
+            if overrides.read is not None:
+                read_timeout = overrides.read
+            expires = min_timeout(expires, overrides.expires)
 
         is_secure = self.is_secure
         host = "%s:%d" % (server, self.port)
+        endpoint_key = self._endpoint_key(bucket)
+        endpoint = self.endpoints.get(endpoint_key)
+        if endpoint is not None:
+            is_secure, host = endpoint
+        redirected = False
+        attempts = 0
+        retryable = self.retry_policy.is_retryable(method, data)
+        position = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            position = data.tell()
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
-            else:
-                connection = httplib.HTTPConnection(host)
-
             final_headers = merge_meta(headers, metadata);
             # add auth header
             self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
 
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
-            if resp.status < 300 or resp.status >= 400:
-                return resp
-            # handle redirect
-            location = resp.getheader('location')
+            attempts += 1
+            if self.rate_limiter is not None and \
+               not self.rate_limiter.acquire(bucket, method, key, expires):
+                raise DeadlineExceeded('The deadline for the request to S3 passed.')
+            try:
+                connection, resp = self._send(is_secure, host, method, path,
+                    data, final_headers, connect_timeout, read_timeout, expires)
+            except DeadlineExceeded:
+                raise
+            except (socket.error, httplib.HTTPException) as e:
+                if not retryable or \
+                   not self._retry(attempts, method, bucket, key, e, expires):
+                    raise
+                if position is not None:
+                    data.seek(position)
+                continue
+            release = ReleaseConnection(self.pool, is_secure, host, connection, resp)
+            if method == 'HEAD':
+                # there is no body so the connection can go straight back
+                resp.read()
+                release()
+            else:
+                resp.release_conn = release
+            if self.rate_limiter is not None:
+                if resp.status == 503:
+                    self.rate_limiter.throttled(bucket, method, key)
+                elif resp.status < 500:
+                    self.rate_limiter.succeeded(bucket, method, key)
+            if retryable and \
+               self.retry_policy.is_retryable_status(resp.status) and \
+               self._retry(attempts, method, bucket, key, resp.status, expires):
+                resp.read()
+                release()
+                if position is not None:
+                    data.seek(position)
+                continue
+            if resp.status < 500:
+                self.retry_policy.succeeded()
+            location = None
+            if 300 <= resp.status < 400:
+                location = resp.getheader('location')
             if not location:
+                if redirected:
+                    # remember the final endpoint, replacing any that had
+                    # itself been redirected
+                    self.endpoints.set(endpoint_key, is_secure, host)
                 return resp
+            # handle redirect
             # (close connection)
             resp.read()
+            release()
             scheme, host, path, params, query, fragment \
                     = urlparse.urlparse(location)
-            if scheme == "http":    is_secure = True
-            elif scheme == "https": is_secure = False
+            if scheme == "http":    is_secure = False
+            elif scheme == "https": is_secure = True
             else: raise S3Exception("Not http/https: " + location)
             if query: path += "?" + query
+            redirected = True
             # retry with redirect
 
+    def _retry(self, attempts, method, bucket, key, reason, expires=None):
+        """
+        Waits before retrying a request if the retry policy allows another
+        attempt before the deadline, returning False if it doesn't.
+        """
+        delay = self.retry_policy.delay(attempts)
+        if expires is not None and time.time() + delay >= expires:
+            return False
+        if not self.retry_policy.should_retry(attempts):
+            return False
+        request_retried.send(
+            sender=self.__class__,
+            method=method,
+            bucket=bucket,
+            key=key,
+            attempt=attempts,
+            reason=reason
+        )
+        time.sleep(delay)
+        return True
+
+    def _remaining(self, expires):
+        if expires is None:
+            return None
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('The deadline for the request to S3 passed.')
+        return remaining
+
+    def _send(self, is_secure, host, method, path, data, headers,
+              connect_timeout=None, read_timeout=None, expires=None):
+        """
+        Sends the request over a pooled connection if there is one, falling
+        back to a fresh connection if the pooled one turns out to have been
+        closed by the server.
+        """
+        connection = self.pool.get(is_secure, host)
+        position = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            position = data.tell()
+        if connection is not None:
+            try:
+                connection.sock.settimeout(
+                    min_timeout(read_timeout, self._remaining(expires)))
+                connection.request(method, path, data, headers)
+                return connection, connection.getresponse()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if position is None and hasattr(data, 'read'):
+                    raise
+                if position is not None:
+                    data.seek(position)
+        connection = self._new_connection(is_secure, host,
+            min_timeout(connect_timeout, self._remaining(expires)))
+        try:
+            connection.connect()
+            connection.sock.settimeout(
+                min_timeout(read_timeout, self._remaining(expires)))
+            connection.request(method, path, data, headers)
+            return connection, connection.getresponse()
+        except:
+            connection.close()
+            raise
+
+    def _new_connection(self, is_secure, host, timeout=None):
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if is_secure:
+            return HTTPSConnection(host, context=self.ssl_context,
+                                   tls_sessions=self.tls_sessions, **kwargs)
+        return httplib.HTTPConnection(host, **kwargs)
+
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
         if not 'Date' in headers:
             headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
@@ -333,6 +724,33 @@ class AWSAuthConnection:
             "AWS %s:%s" % (self.aws_access_key_id, encode(self.aws_secret_access_key, c_string))
 
 
+class ReleaseConnection:
+    """
+    Returns a connection to its pool once its response has been completely
+    read, or closes it if it can't be reused.
+    """
+    def __init__(self, pool, is_secure, host, connection, http_response):
+        self.pool = pool
+        self.is_secure = is_secure
+        self.host = host
+        self.connection = connection
+        self.http_response = http_response
+
+    def __call__(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        if self.http_response.isclosed():
+            self.pool.put(self.is_secure, self.host, connection)
+        else:
+            connection.close()
+
+def release_connection(http_response):
+    release = getattr(http_response, 'release_conn', None)
+    if release is not None:
+        release()
+
+
 class QueryStringAuthGenerator:
     # by default, expire in 1 minute
     DEFAULT_EXPIRES_IN = 60
@@ -474,11 +892,15 @@ class Bucket:
         self.creation_date = creation_date
 
 class Response:
+    # the code of an error reported in the body of a successful response
+    error = None
+
     def __init__(self, http_response):
         self.http_response = http_response
         # you have to do this read, even if you don't expect a body.
         # otherwise, the next request fails.
         self.body = http_response.read()
+        release_connection(http_response)
         if http_response.status >= 300 and self.body:
             self.message = self.body
         else:
@@ -530,6 +952,68 @@ class GetResponse(Response):
 
         return metadata
 
+class StreamingGetResponse(GetResponse):
+    """
+    A GetResponse which leaves the body of successful responses to be read in
+    chunks with iter_chunks() instead of reading it all into memory.
+    """
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, http_response):
+        if http_response.status >= 300:
+            GetResponse.__init__(self, http_response)
+            return
+        self.http_response = http_response
+        self.body = None
+        self.message = "%03d %s" % (http_response.status, http_response.reason)
+        metadata = self.get_aws_metadata(http_response.msg)
+        self.object = S3Object(None, metadata)
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        if self.body is not None:
+            if self.body:
+                yield self.body
+            return
+        try:
+            while True:
+                chunk = self.http_response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        # The connection is only reused if the body was read to the end.
+        release_connection(self.http_response)
+
+class InitiateMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = ElementHandler('UploadId')
+            xml.sax.parseString(self.body, handler)
+            self.upload_id = handler.value
+
+class CompleteMultipartUploadResponse(Response):
+    """
+    S3 can report that completing an upload failed after it has already sent
+    a 200 status, in which case ``error`` is set.
+    """
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.etag = None
+        if http_response.status < 300:
+            handler = ElementHandler('ETag')
+            xml.sax.parseString(self.body, handler)
+            if handler.root == 'Error':
+                handler = ElementHandler('Code')
+                xml.sax.parseString(self.body, handler)
+                self.error = handler.value or 'InternalError'
+                self.message = self.body
+            else:
+                self.etag = handler.value
+
 class LocationResponse(Response):
     def __init__(self, http_response):
         Response.__init__(self, http_response)
@@ -649,3 +1133,28 @@ class LocationHandler(xml.sax.ContentHandler):
     def characters(self, content):
         if self.state == 'tag_location':
             self.location += content
+
+class ElementHandler(xml.sax.ContentHandler):
+    """
+    Collects the text of the first element called ``name``.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.root = None
+        self.value = None
+        self.state = 'init'
+
+    def startElement(self, name, attrs):
+        if self.root is None:
+            self.root = name
+        if self.state == 'init' and name == self.name:
+            self.state = 'tag_value'
+            self.value = ''
+
+    def endElement(self, name):
+        if self.state == 'tag_value' and name == self.name:
+            self.state = 'done'
+
+    def characters(self, content):
+        if self.state == 'tag_value':
+            self.value += content
@@ -1,16 +1,58 @@
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7
+    ContextVar = None
 try:
     from threading import local
 except ImportError:
     from django.utils._threading_local import local
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+
+# Context variables follow each request through both threads and async tasks,
+# thread locals are only used where they aren't available.
+if ContextVar is not None:
+    _request_is_secure = ContextVar('cb_request_is_secure', default=None)
+    _request_memo = ContextVar('cb_request_memo', default=None)
 
+    def request_is_secure():
+        return _request_is_secure.get()
 
-_thread_locals = local()
+    def set_request_is_secure(is_secure):
+        _request_is_secure.set(is_secure)
 
+    def request_memo():
+        return _request_memo.get()
 
-def request_is_secure():
-    return getattr(_thread_locals, 'cb_request_is_secure', None)
+    def set_request_memo(memo):
+        _request_memo.set(memo)
+else:
+    _thread_locals = local()
 
+    def request_is_secure():
+        return getattr(_thread_locals, 'cb_request_is_secure', None)
 
-class ThreadLocals(object):
+    def set_request_is_secure(is_secure):
+        _thread_locals.cb_request_is_secure = is_secure
+
+    def request_memo():
+        return getattr(_thread_locals, 'cb_request_memo', None)
+
+    def set_request_memo(memo):
+        _thread_locals.cb_request_memo = memo
+
+
+class ThreadLocals(MiddlewareMixin):
     def process_request(self, request):
-        _thread_locals.cb_request_is_secure = request.is_secure()
+        set_request_is_secure(request.is_secure())
+        # The storage remembers the responses to HEAD requests made during
+        # the request here so each file is only checked once.
+        set_request_memo({})
+
+    def process_response(self, request, response):
+        set_request_memo(None)
+        return response
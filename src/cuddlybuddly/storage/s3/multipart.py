@@ -0,0 +1,164 @@
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, \
+    ThreadPoolExecutor, wait
+from cuddlybuddly.storage.s3.lib import call_with_timeouts, current_timeouts
+
+
+# Files larger than this are uploaded in parts.
+DEFAULT_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+# S3 rejects parts smaller than this, except for the last one, and uploads
+# of more than MAX_PARTS parts.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def get_part_size(size, part_size=DEFAULT_PART_SIZE):
+    """
+    Returns the size of the parts to upload ``size`` bytes in, increasing
+    ``part_size`` if needed to keep within S3's limits.
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size > part_size * MAX_PARTS:
+        part_size = -(-size // MAX_PARTS)
+    return part_size
+
+
+class MultipartWriter(object):
+    """
+    Uploads an object in parts as they're written, ``concurrency`` of them at
+    a time, so that at most ``concurrency + 1`` parts are held in memory.
+
+    If ``start`` or ``write`` return a response then that part of the upload
+    failed and it has been aborted. ``headers`` are those of the object being
+    uploaded and so shouldn't include a Content-Length.
+    """
+
+    def __init__(self, connection, bucket, key, headers={},
+                 concurrency=DEFAULT_CONCURRENCY):
+        self.connection = connection
+        self.bucket = bucket
+        self.key = key
+        self.headers = headers
+        self.concurrency = concurrency
+        self.upload_id = None
+        self.failed = None
+        self._etags = []
+        self._pending = {}
+        self._executor = None
+
+    def start(self):
+        response = self.connection.initiate_multipart_upload(
+            self.bucket, self.key, self.headers)
+        if response.http_response.status != 200:
+            self.failed = response
+            return response
+        self.upload_id = response.upload_id
+        self._timeouts = current_timeouts()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return None
+
+    def write(self, data):
+        """
+        Uploads the next part, waiting first if ``concurrency`` parts are
+        already being uploaded.
+        """
+        if self.failed is not None:
+            return self.failed
+        self._etags.append(None)
+        try:
+            future = self._executor.submit(
+                call_with_timeouts, self._timeouts,
+                self.connection.upload_part, self.bucket, self.key,
+                self.upload_id, len(self._etags), data)
+            self._pending[future] = len(self._etags)
+            if len(self._pending) >= self.concurrency:
+                self._collect(FIRST_COMPLETED)
+        except:
+            self.abort()
+            raise
+        if self.failed is not None:
+            self.abort()
+        return self.failed
+
+    def complete(self):
+        """
+        Returns the response to completing the upload or the first failed
+        response, in which case the upload has been aborted.
+        """
+        if self.failed is not None:
+            return self.failed
+        try:
+            if not self._etags:
+                # There has to be at least one part, even if it's empty.
+                self.write(b'')
+            self._collect(ALL_COMPLETED)
+            self._executor.shutdown(wait=True)
+            if self.failed is None:
+                response = self.connection.complete_multipart_upload(
+                    self.bucket, self.key, self.upload_id, self._etags)
+                if response.http_response.status == 200 and \
+                   response.error is None:
+                    return response
+                self.failed = response
+        except:
+            self.abort()
+            raise
+        self.abort()
+        return self.failed
+
+    def abort(self):
+        if self._executor is not None:
+            # Let any parts still being uploaded finish before aborting.
+            self._executor.shutdown(wait=True)
+        if self.upload_id is None:
+            return
+        upload_id, self.upload_id = self.upload_id, None
+        try:
+            self.connection.abort_multipart_upload(self.bucket, self.key,
+                                                   upload_id)
+        except Exception:
+            # The upload has already failed and S3 can be told to clean up
+            # abandoned uploads with a lifecycle rule.
+            pass
+
+    def _collect(self, return_when):
+        """
+        Waits for uploads of parts to finish, recording their ETags and the
+        first failed response.
+        """
+        for future in wait(self._pending, return_when=return_when)[0]:
+            part_number = self._pending.pop(future)
+            response = future.result()
+            if response.http_response.status != 200:
+                if self.failed is None:
+                    self.failed = response
+            else:
+                self._etags[part_number - 1] = \
+                    response.http_response.getheader('ETag')
+
+
+def upload(connection, bucket, key, content, size, headers={},
+           part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Uploads ``size`` bytes read from the file like object ``content`` with a
+    MultipartWriter, returning the response to completing the upload or the
+    first failed response.
+    """
+    writer = MultipartWriter(connection, bucket, key, headers, concurrency)
+    failed = writer.start()
+    if failed is not None:
+        return failed
+    part_size = get_part_size(size, part_size)
+    try:
+        while True:
+            data = content.read(part_size)
+            if not data:
+                break
+            failed = writer.write(data)
+            if failed is not None:
+                return failed
+    except:
+        writer.abort()
+        raise
+    return writer.complete()
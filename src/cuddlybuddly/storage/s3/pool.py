@@ -0,0 +1,237 @@
+try:
+    import http.client as httplib # Python 3
+except ImportError:
+    import httplib # Python 2
+import os
+import select
+import ssl
+import threading
+import time
+
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_TLS_SESSIONS = 64
+
+
+def create_ssl_context(cafile=None):
+    """
+    Returns an SSLContext verifying certificates against ``cafile`` or the
+    system's default CA bundle, which is only loaded this once.
+    """
+    return ssl.create_default_context(cafile=cafile)
+
+
+class TLSSessionCache(object):
+    """
+    Remembers the last TLS session negotiated with each host so that new
+    connections can do an abbreviated handshake. Sessions can only be resumed
+    with the SSLContext that created them so each context needs its own cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_TLS_SESSIONS):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, host):
+        with self._lock:
+            return self._sessions.get(host)
+
+    def save(self, host, sock):
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        with self._lock:
+            if host not in self._sessions and \
+               len(self._sessions) >= self.max_size:
+                self._sessions.pop(next(iter(self._sessions)))
+            self._sessions[host] = session
+
+    def remove(self, host):
+        with self._lock:
+            self._sessions.pop(host, None)
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    """
+    An HTTPSConnection that resumes a cached TLS session when connecting and
+    caches the one it ends up with.
+    """
+
+    def __init__(self, host, tls_sessions=None, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.tls_sessions = tls_sessions
+
+    def connect(self):
+        if self.tls_sessions is None:
+            return httplib.HTTPSConnection.connect(self)
+        httplib.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        session = self.tls_sessions.get(server_hostname)
+        sock = self.sock
+        if session is not None:
+            try:
+                self.sock = self._context.wrap_socket(
+                    sock,
+                    server_hostname=server_hostname,
+                    session=session
+                )
+                return
+            except (ValueError, ssl.SSLError):
+                # The session expired or was rejected, so start again with a
+                # full handshake.
+                self.tls_sessions.remove(server_hostname)
+                sock.close()
+                httplib.HTTPConnection.connect(self)
+                sock = self.sock
+        self.sock = self._context.wrap_socket(
+            sock,
+            server_hostname=server_hostname
+        )
+
+    def getresponse(self):
+        response = httplib.HTTPSConnection.getresponse(self)
+        # TLS 1.3 only sends the session ticket after the handshake so cache
+        # the session once something has been read.
+        if self.tls_sessions is not None and self.sock is not None and \
+           not getattr(self.sock, 'session_reused', False):
+            self.tls_sessions.save(self._tunnel_host or self.host, self.sock)
+        return response
+
+
+def is_connection_dropped(connection):
+    """
+    Returns True if an idle connection can't be reused.
+
+    An idle keep-alive socket should never be readable, if it is then the
+    server has either closed it or sent something we weren't expecting.
+    """
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        return True
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+    except (ValueError, select.error):
+        return True
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of idle keep-alive HTTP connections keyed by the
+    security and ``host:port`` of the endpoint.
+
+    ``max_size`` is the number of idle connections kept for each endpoint and
+    connections idle for longer than ``idle_timeout`` seconds are closed
+    instead of being reused.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # Sockets inherited across a fork are shared with the parent process
+        # so forget about them without closing them.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def get(self, is_secure, host):
+        """
+        Returns an idle connection to ``host`` or None if there isn't a
+        usable one.
+        """
+        self._check_pid()
+        now = time.time()
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get((is_secure, host))
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used > self.idle_timeout or \
+                   is_connection_dropped(conn):
+                    stale.append(conn)
+                else:
+                    connection = conn
+                    break
+        for conn in stale:
+            conn.close()
+        return connection
+
+    def put(self, is_secure, host, connection):
+        """
+        Returns a connection to the pool once its response has been read.
+        """
+        if connection.sock is None:
+            # The server asked for the connection to be closed.
+            return
+        self._check_pid()
+        now = time.time()
+        stale = []
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    stale.append(idle.pop(0)[0])
+            idle = self._idle.setdefault((is_secure, host), [])
+            if len(idle) < self.max_size:
+                idle.append((connection, now))
+            else:
+                stale.append(connection)
+        for conn in stale:
+            conn.close()
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        self._check_pid()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """
+    Returns the process wide pool shared by every connection that isn't given
+    one explicitly, configured from the settings on first use.
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                from django.conf import settings
+                _default_pool = ConnectionPool(
+                    max_size=getattr(
+                        settings,
+                        'CUDDLYBUDDLY_STORAGE_S3_POOL_SIZE',
+                        DEFAULT_MAX_SIZE
+                    ),
+                    idle_timeout=getattr(
+                        settings,
+                        'CUDDLYBUDDLY_STORAGE_S3_POOL_IDLE_TIMEOUT',
+                        DEFAULT_IDLE_TIMEOUT
+                    )
+                )
+    return _default_pool
+
+
+if hasattr(os, 'register_at_fork'):
+    def _after_fork():
+        if _default_pool is not None:
+            _default_pool._reset()
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,158 @@
+import threading
+import time
+
+
+# S3's documented request rates per prefix per second
+DEFAULT_READ_RATE = 5500
+DEFAULT_WRITE_RATE = 3500
+DEFAULT_MIN_RATE = 1
+
+READ = 'read'
+WRITE = 'write'
+
+
+def operation_class(method, key):
+    """
+    Returns whether a request counts towards the read or write limits of a
+    bucket. Listing a bucket counts as a write as S3 throttles them alike.
+    """
+    if method in ('GET', 'HEAD') and key:
+        return READ
+    return WRITE
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` requests per second with bursts of up to a second's worth
+    of requests.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.last_decrease = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.rate,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self, expires=None):
+        """
+        Waits until a request can be made, returning False without waiting if
+        that wouldn't be until after ``expires``.
+        """
+        wait = self.reserve(expires)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def reserve(self, expires=None):
+        """
+        Reserves a request without waiting, returning how many seconds to
+        wait before making it, or None if that would be after ``expires``.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            wait = 0
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+            if expires is not None and now + wait > expires:
+                return None
+            # Reserve the token now so concurrent callers queue up behind us.
+            self.tokens -= 1
+        return wait
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Limits the rate of requests to each bucket, separately for reads and
+    writes, adapting the rates using additive increase and multiplicative
+    decrease (AIMD).
+
+    Each throttled response multiplies the rate by ``decrease``, at most once
+    every ``cooldown`` seconds so a burst of throttled responses to concurrent
+    requests only counts once. Each successful response increases the rate by
+    ``increase`` requests per second, up to the initial rate.
+    """
+
+    def __init__(self, read_rate=DEFAULT_READ_RATE,
+                 write_rate=DEFAULT_WRITE_RATE, min_rate=DEFAULT_MIN_RATE,
+                 increase=1, decrease=0.5, cooldown=1):
+        self.max_rates = {READ: read_rate, WRITE: write_rate}
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, bucket, method, key):
+        op = operation_class(method, key)
+        with self._lock:
+            token_bucket = self._buckets.get((bucket, op))
+            if token_bucket is None:
+                token_bucket = TokenBucket(self.max_rates[op])
+                self._buckets[(bucket, op)] = token_bucket
+            return token_bucket, self.max_rates[op]
+
+    def acquire(self, bucket, method, key, expires=None):
+        return self._bucket(bucket, method, key)[0].acquire(expires)
+
+    def reserve(self, bucket, method, key, expires=None):
+        """
+        The non-blocking version of ``acquire`` for use with asyncio, see
+        ``TokenBucket.reserve``.
+        """
+        return self._bucket(bucket, method, key)[0].reserve(expires)
+
+    def throttled(self, bucket, method, key):
+        token_bucket = self._bucket(bucket, method, key)[0]
+        with token_bucket._lock:
+            now = time.time()
+            if now - token_bucket.last_decrease < self.cooldown:
+                return
+            token_bucket._refill(now)
+            token_bucket.rate = max(
+                self.min_rate,
+                token_bucket.rate * self.decrease
+            )
+            token_bucket.tokens = min(token_bucket.tokens, token_bucket.rate)
+            token_bucket.last_decrease = now
+
+    def succeeded(self, bucket, method, key):
+        token_bucket, max_rate = self._bucket(bucket, method, key)
+        if token_bucket.rate >= max_rate:
+            return
+        with token_bucket._lock:
+            token_bucket._refill(time.time())
+            token_bucket.rate = min(max_rate,
+                                    token_bucket.rate + self.increase)
+
+    def rate(self, bucket, method, key):
+        return self._bucket(bucket, method, key)[0].rate
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(read_rate=DEFAULT_READ_RATE,
+                     write_rate=DEFAULT_WRITE_RATE):
+    """
+    Returns a process wide rate limiter so that every storage using the same
+    rates shares one.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get((read_rate, write_rate))
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(read_rate, write_rate)
+            _limiters[(read_rate, write_rate)] = limiter
+        return limiter
@@ -0,0 +1,126 @@
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_READ_AHEAD = 1024 * 1024
+# The number of blocks kept on top of a full read-ahead window.
+EXTRA_BLOCKS = 8
+DEFAULT_RANGE_GAP = 32 * 1024
+
+
+def coalesce_ranges(ranges, gap=DEFAULT_RANGE_GAP):
+    """
+    Merges ``(offset, length)`` ranges which overlap or are separated by at
+    most ``gap`` bytes, as fetching the bytes in between is cheaper than
+    another request.
+
+    Returns a list of ``(start, end, indexes)`` tuples where ``end`` is
+    exclusive and ``indexes`` are the positions in ``ranges`` of the ranges
+    that were merged.
+    """
+    merged = []
+    order = sorted(
+        [i for i, (offset, length) in enumerate(ranges) if length > 0],
+        key=lambda i: ranges[i][0]
+    )
+    for i in order:
+        offset, length = ranges[i]
+        if merged and offset <= merged[-1][1] + gap:
+            start, end, indexes = merged[-1]
+            merged[-1] = (start, max(end, offset + length), indexes + [i])
+        else:
+            merged.append((offset, offset + length, [i]))
+    return merged
+
+
+class ReadAheadBuffer(object):
+    """
+    Serves reads from aligned blocks of ``block_size`` bytes fetched with
+    ``fetch(start, end)``, which returns the bytes between the inclusive
+    offsets ``start`` and ``end`` along with the total size if it's known.
+
+    Recently used blocks are kept so seeking back doesn't fetch them again.
+    While reads are sequential each fetch also reads ahead, doubling the
+    amount each time up to ``max_read_ahead`` bytes.
+    """
+
+    def __init__(self, fetch, block_size=DEFAULT_BLOCK_SIZE,
+                 max_read_ahead=DEFAULT_MAX_READ_AHEAD, max_blocks=None):
+        self.fetch = fetch
+        self.block_size = block_size
+        self.max_read_ahead = max_read_ahead
+        if max_blocks is None:
+            max_blocks = max_read_ahead // block_size + EXTRA_BLOCKS
+        self.max_blocks = max_blocks
+        self.size = None
+        self.clear()
+
+    def clear(self):
+        self._blocks = OrderedDict()
+        self._read_ahead = 0
+        self._next = None
+
+    def read(self, pos, num_bytes):
+        if self.size is not None:
+            num_bytes = min(num_bytes, self.size - pos)
+        if num_bytes <= 0:
+            return b''
+        end = pos + num_bytes
+        first, last = pos // self.block_size, (end - 1) // self.block_size
+        blocks = {}
+        missing = []
+        for i in range(first, last + 1):
+            block = self._blocks.get(i)
+            if block is None:
+                missing.append(i)
+            else:
+                self._blocks.pop(i)
+                self._blocks[i] = block
+                blocks[i] = block
+        if missing:
+            if pos == self._next:
+                self._read_ahead = min(
+                    max(self._read_ahead * 2, self.block_size),
+                    self.max_read_ahead
+                )
+            else:
+                self._read_ahead = 0
+            blocks.update(self._fetch(
+                missing[0],
+                max(missing[-1], (end - 1 + self._read_ahead) // self.block_size)
+            ))
+        data = []
+        for i in range(first, last + 1):
+            block = blocks.get(i)
+            if block is None:
+                break
+            data.append(block)
+            if len(block) < self.block_size:
+                break
+        data = b''.join(data)
+        data = data[pos - first * self.block_size:end - first * self.block_size]
+        self._next = pos + len(data)
+        return data
+
+    def _fetch(self, first, last):
+        if self.size is not None:
+            last = min(last, (self.size - 1) // self.block_size)
+        data, size = self.fetch(first * self.block_size,
+                                (last + 1) * self.block_size - 1)
+        if size is not None:
+            self.size = size
+        blocks = {}
+        for i in range(first, last + 1):
+            offset = (i - first) * self.block_size
+            block = data[offset:offset + self.block_size]
+            if not block:
+                break
+            blocks[i] = block
+            self._blocks.pop(i, None)
+            self._blocks[i] = block
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return blocks
@@ -0,0 +1,90 @@
+import random
+import threading
+
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.1
+DEFAULT_MAX_BACKOFF = 5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class RetryBudget(object):
+    """
+    A process wide token bucket limiting how many retries can be made so that
+    retries don't amplify an outage.
+
+    Every retry withdraws ``retry_cost`` tokens and every successful request
+    deposits ``success_deposit`` tokens, up to ``capacity``. Once the bucket
+    is empty requests fail straight away until enough have succeeded again.
+    """
+
+    def __init__(self, capacity=100, retry_cost=5, success_deposit=1):
+        self.capacity = capacity
+        self.retry_cost = retry_cost
+        self.success_deposit = success_deposit
+        self._tokens = capacity
+        self._lock = threading.Lock()
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < self.retry_cost:
+                return False
+            self._tokens -= self.retry_cost
+            return True
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity,
+                               self._tokens + self.success_deposit)
+
+
+default_budget = RetryBudget()
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request can be retried and how long to wait
+    before doing so, using exponential backoff with full jitter.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 budget=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if budget is None:
+            budget = default_budget
+        self.budget = budget
+
+    def is_retryable(self, method, data):
+        """
+        Returns True if the request can safely be sent again. PUTs can only be
+        retried if their body can be sent again.
+        """
+        if method in ('GET', 'HEAD', 'DELETE'):
+            return True
+        if method == 'PUT':
+            if hasattr(data, 'read'):
+                return hasattr(data, 'seek') and hasattr(data, 'tell')
+            return True
+        return False
+
+    def is_retryable_status(self, status):
+        return status in RETRY_STATUSES
+
+    def should_retry(self, attempts):
+        """
+        Returns True if another attempt can be made after ``attempts``
+        attempts have failed.
+        """
+        return attempts < self.max_attempts and self.budget.withdraw()
+
+    def delay(self, attempts):
+        return random.uniform(
+            0,
+            min(self.max_backoff, self.backoff * (2 ** (attempts - 1)))
+        )
+
+    def succeeded(self):
+        self.budget.deposit()
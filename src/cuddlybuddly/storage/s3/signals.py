@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# Sent with method, bucket, key, attempt and reason arguments every time a
+# request to S3 is retried.
+request_retried = Signal()
@@ -0,0 +1,57 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = False
+
+
+class SingleFlight(object):
+    """
+    Makes concurrent calls with the same key share the result of one call,
+    so a burst of identical requests only goes to S3 once.
+
+    Calls made once the first has finished make a new call, so results are
+    never reused after the fact.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Returns the result of ``func(*args, **kwargs)``, or of the call with
+        the same key that is already in flight, raising its exception if it
+        failed.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if not call.finished:
+                # The call was interrupted, such as by KeyboardInterrupt in
+                # its thread, so there's nothing to share.
+                return func(*args, **kwargs)
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            call.finished = True
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -1,44 +1,98 @@
 from calendar import timegm
 from datetime import datetime
 from email.utils import parsedate
-from gzip import GzipFile
 from importlib import import_module
 import mimetypes
 import os
 import re
+import struct
+import threading
 try:
     from io import BytesIO as StringIO # Python 3
 except ImportError:
     # Don't use cStringIO as it's not unicode safe
     from StringIO import StringIO # Python 2
 import sys
+from tempfile import SpooledTemporaryFile
 try:
     from urllib.parse import urljoin # Python 3
 except ImportError:
     from urlparse import urljoin # Python 2
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import File
 from django.core.files.storage import Storage
 from django.utils.encoding import iri_to_uri
 from cuddlybuddly.storage.s3 import CallingFormat
+try:
+    from cuddlybuddly.storage.s3.aio import AsyncStorageMixin, \
+        AsyncStorageFileMixin
+except (ImportError, SyntaxError): # Python < 3.7
+    class AsyncStorageMixin(object):
+        pass
+    class AsyncStorageFileMixin(object):
+        pass
+from cuddlybuddly.storage.s3 import compress
+from cuddlybuddly.storage.s3.cache import ChainCache
+from cuddlybuddly.storage.s3.contentcache import ContentCache
 from cuddlybuddly.storage.s3.exceptions import S3Error
-from cuddlybuddly.storage.s3.lib import AWSAuthConnection
-from cuddlybuddly.storage.s3.middleware import request_is_secure
+from cuddlybuddly.storage.s3.lib import AWSAuthConnection, \
+    DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, EndpointCache, \
+    call_with_timeouts, current_timeouts
+from cuddlybuddly.storage.s3.middleware import request_is_secure, \
+    request_memo
+from cuddlybuddly.storage.s3 import multipart
+from cuddlybuddly.storage.s3.pool import create_ssl_context
+from cuddlybuddly.storage.s3.ratelimit import DEFAULT_READ_RATE, \
+    DEFAULT_WRITE_RATE, get_rate_limiter
+from cuddlybuddly.storage.s3.readahead import DEFAULT_BLOCK_SIZE, \
+    DEFAULT_MAX_READ_AHEAD, DEFAULT_RANGE_GAP, ReadAheadBuffer, \
+    coalesce_ranges
+from cuddlybuddly.storage.s3.retry import DEFAULT_BACKOFF, \
+    DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_BACKOFF, RetryPolicy
+from cuddlybuddly.storage.s3.singleflight import SingleFlight
 
 
 ACCESS_KEY_NAME = 'AWS_ACCESS_KEY_ID'
 SECRET_KEY_NAME = 'AWS_SECRET_ACCESS_KEY'
 HEADERS = 'AWS_HEADERS'
+# Files being written are kept in memory until they get this large.
+DEFAULT_SPOOL_SIZE = 5 * 1024 * 1024
+# stat_many lists a directory instead of making a HEAD request for each file
+# when it has to look up at least this many files in it.
+STAT_LIST_THRESHOLD = 5
+DEFAULT_STAT_CONCURRENCY = 10
+
+
+if hasattr(os, 'pwrite'):
+    def pwrite(fd, data, offset):
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+else:
+    _pwrite_lock = threading.Lock()
+
+    def pwrite(fd, data, offset):
+        # Without positional writes seeking and writing has to be atomic.
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = memoryview(data)
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
 
 
-class S3Storage(Storage):
+class S3Storage(AsyncStorageMixin, Storage):
     """Amazon Simple Storage Service"""
 
     static = False
 
     def __init__(self, bucket=None, access_key=None, secret_key=None,
-                 headers=None, calling_format=None, cache=None, base_url=None):
+                 headers=None, calling_format=None, cache=None, base_url=None,
+                 content_cache=None):
         if bucket is None:
             bucket = settings.AWS_STORAGE_BUCKET_NAME
         if calling_format is None:
@@ -49,8 +103,64 @@ class S3Storage(Storage):
         if not access_key and not secret_key:
             access_key, secret_key = self._get_access_keys()
 
+        ssl_context = create_ssl_context(
+            getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CA_BUNDLE', None)
+        )
+        retry_policy = RetryPolicy(
+            max_attempts=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MAX_ATTEMPTS',
+                DEFAULT_MAX_ATTEMPTS
+            ),
+            backoff=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_RETRY_BACKOFF',
+                DEFAULT_BACKOFF
+            ),
+            max_backoff=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_RETRY_MAX_BACKOFF',
+                DEFAULT_MAX_BACKOFF
+            )
+        )
+        rate_limit = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_RATE_LIMIT',
+            (DEFAULT_READ_RATE, DEFAULT_WRITE_RATE)
+        )
+        rate_limiter = None
+        if rate_limit is not None:
+            rate_limiter = get_rate_limiter(*rate_limit)
         self.connection = AWSAuthConnection(access_key, secret_key,
-                            calling_format=calling_format)
+                            calling_format=calling_format,
+                            ssl_context=ssl_context,
+                            endpoint_ttl=getattr(
+                                settings,
+                                'CUDDLYBUDDLY_STORAGE_S3_ENDPOINT_TTL',
+                                EndpointCache.DEFAULT_TTL
+                            ),
+                            resolve_location=getattr(
+                                settings,
+                                'CUDDLYBUDDLY_STORAGE_S3_RESOLVE_LOCATION',
+                                False
+                            ),
+                            retry_policy=retry_policy,
+                            connect_timeout=getattr(
+                                settings,
+                                'CUDDLYBUDDLY_STORAGE_S3_CONNECT_TIMEOUT',
+                                DEFAULT_CONNECT_TIMEOUT
+                            ),
+                            read_timeout=getattr(
+                                settings,
+                                'CUDDLYBUDDLY_STORAGE_S3_READ_TIMEOUT',
+                                DEFAULT_READ_TIMEOUT
+                            ),
+                            deadline=getattr(
+                                settings,
+                                'CUDDLYBUDDLY_STORAGE_S3_DEADLINE',
+                                None
+                            ),
+                            rate_limiter=rate_limiter)
 
         default_headers = getattr(settings, HEADERS, [])
         # Backwards compatibility for original format from django-storages
@@ -68,11 +178,24 @@ class S3Storage(Storage):
             self.cache = cache
         else:
             cache = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CACHE', None)
-            if cache is not None:
+            if isinstance(cache, (list, tuple)):
+                self.cache = ChainCache(
+                    [self._get_cache_class(path)() for path in cache]
+                )
+            elif cache is not None:
                 self.cache = self._get_cache_class(cache)()
             else:
                 self.cache = None
 
+        self._flights = SingleFlight()
+
+        if content_cache is not None:
+            self.content_cache = content_cache
+        elif getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_DIR', None):
+            self.content_cache = ContentCache()
+        else:
+            self.content_cache = None
+
         if base_url is None:
             if not self.static:
                 base_url = settings.MEDIA_URL
@@ -118,23 +241,117 @@ class S3Storage(Storage):
         return AWSAuthConnection(*self._get_access_keys())
 
     def _put_file(self, name, content):
-        name = self._path(name)
-        placeholder = False
+        threshold = self._multipart_threshold()
+        name, headers, content_to_send, content_length, file_pos, \
+            placeholder = self._prepare_put(name, content, threshold)
+        if self._use_multipart(content_to_send, content_length, threshold):
+            response, content_length = self._put_large(
+                name, headers, content_to_send, content_length
+            )
+        else:
+            response = self.connection.put(self.bucket, name, content_to_send, headers)
+        self._finish_put(name, content, response, content_length, file_pos,
+                         placeholder)
+
+    def _multipart_threshold(self):
+        return getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD',
+            multipart.DEFAULT_THRESHOLD
+        )
+
+    def _use_multipart(self, content, content_length, threshold):
+        # Content gzipped while it's being uploaded has no length.
+        return content_length is None or (
+            threshold is not None and content_length > threshold and
+            hasattr(content, 'read')
+        )
+
+    def _put_large(self, name, headers, content, content_length):
+        """
+        Uploads content in parts, returning the response and the length of
+        what was uploaded.
+        """
+        if content_length is None:
+            # Gzipped while it's being uploaded
+            response = self._put_multipart(name, content, content.size,
+                                           headers)
+            if response.http_response.status == 200:
+                compress.default_history.record(
+                    headers['Content-Type'],
+                    content.raw_length,
+                    content.length
+                )
+            return response, content.length
+        return self._put_multipart(name, content, content_length,
+                                   headers), content_length
+
+    def _put_multipart(self, name, content, content_length, headers):
+        headers = headers.copy()
+        headers.pop('Content-Length', None)
+        return multipart.upload(
+            self.connection,
+            self.bucket,
+            name,
+            content,
+            content_length,
+            headers,
+            part_size=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE',
+                multipart.DEFAULT_PART_SIZE
+            ),
+            concurrency=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CONCURRENCY',
+                multipart.DEFAULT_CONCURRENCY
+            )
+        )
+
+    def _multipart_writer(self, name, headers):
+        return multipart.MultipartWriter(
+            self.connection,
+            self.bucket,
+            name,
+            headers,
+            concurrency=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CONCURRENCY',
+                multipart.DEFAULT_CONCURRENCY
+            )
+        )
+
+    def _save_placeholder(self, name):
+        """
+        Saves name to the cache while it's being uploaded, returning True if
+        it wasn't there before.
+        """
         if self.cache:
             if not self.cache.exists(name):
                 self.cache.save(name, 0, 0)
-                placedholder = True
-        content_type = mimetypes.guess_type(name)[0] or "application/x-octet-stream"
+                return True
+        return False
+
+    def _put_headers(self, name):
         headers = {}
         for pattern in self.headers:
             if pattern[0].match(name):
                 headers = pattern[1].copy()
                 break
-        file_pos = content.tell()
-        content.seek(0, 2)
-        content_length = content.tell()
-        content.seek(0)
-        gz_cts = getattr(
+        headers['Content-Type'] = mimetypes.guess_type(name)[0] or \
+            "application/x-octet-stream"
+        return headers
+
+    def _may_be_gzipped(self, name):
+        """
+        Returns True if name has a content type that is gzipped when it's
+        uploaded, in which case S3's Content-Length is the compressed size.
+        """
+        content_type = mimetypes.guess_type(self._path(name))[0]
+        return content_type in self._gzip_content_types()
+
+    def _gzip_content_types(self):
+        return getattr(
             settings,
             'CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES',
             (
@@ -143,27 +360,53 @@ class S3Storage(Storage):
                 'application/x-javascript'
             )
         )
+
+    def _prepare_put(self, name, content, multipart_threshold=None):
+        """
+        Returns the headers and content to upload for name. Files that should
+        be gzipped are compressed to a spooled file, unless they're larger
+        than multipart_threshold in which case the content is a GzipStream to
+        be uploaded in parts as it's compressed and the length is None.
+        """
+        name = self._path(name)
+        placeholder = self._save_placeholder(name)
+        headers = self._put_headers(name)
+        content_type = headers['Content-Type']
+        file_pos = content.tell()
+        content.seek(0, 2)
+        content_length = content.tell()
+        content.seek(0)
         gz_content = None
-        if content_length > 1024 and content_type in gz_cts:
-            gz_content = StringIO()
-            gzf = GzipFile(mode='wb', fileobj=gz_content)
-            gzf.write(content.read())
+        if content_length > 1024 and \
+           content_type in self._gzip_content_types() and \
+           compress.should_gzip(content, content_type):
+            headers['Content-Encoding'] = 'gzip'
+            if multipart_threshold is not None and \
+               content_length > multipart_threshold:
+                gz_content = compress.GzipStream(content, content_length)
+                return name, headers, gz_content, None, file_pos, placeholder
+            gz_content = SpooledTemporaryFile(max_size=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_SPOOL_SIZE',
+                DEFAULT_SPOOL_SIZE
+            ))
+            stream = compress.GzipStream(content)
+            while True:
+                data = stream.read(compress.DEFAULT_CHUNK_SIZE)
+                if not data:
+                    break
+                gz_content.write(data)
             content.seek(0)
-            gzf.close()
-            gz_content.seek(0, 2)
-            gz_content_length = gz_content.tell()
             gz_content.seek(0)
-            if gz_content_length < content_length:
-                content_length = gz_content_length
-                headers.update({
-                    'Content-Encoding': 'gzip'
-                })
+            compress.default_history.record(content_type, content_length,
+                                            stream.length)
+            if stream.length < content_length:
+                content_length = stream.length
             else:
+                del headers['Content-Encoding']
+                gz_content.close()
                 gz_content = None
-        headers.update({
-            'Content-Type': content_type,
-            'Content-Length': str(content_length)
-        })
+        headers['Content-Length'] = str(content_length)
         # Httplib in < 2.6 doesn't accept file like objects. Meanwhile in
         # >= 2.7 it will try to join a content str object with the headers which
         # results in encoding problems.
@@ -171,12 +414,20 @@ class S3Storage(Storage):
             content_to_send = gz_content.read() if gz_content is not None else content.read()
         else:
             content_to_send = gz_content if gz_content is not None else content
-        response = self.connection.put(self.bucket, name, content_to_send, headers)
+        return name, headers, content_to_send, content_length, file_pos, \
+            placeholder
+
+    def _finish_put(self, name, content, response, content_length, file_pos,
+                    placeholder):
         content.seek(file_pos)
-        if response.http_response.status != 200:
+        self._forget_head(name)
+        if response.http_response.status != 200 or \
+           response.error is not None:
             if placeholder:
                 self.cache.remove(name)
             raise S3Error(response.message)
+        if self.content_cache:
+            self.content_cache.remove(self._content_key(name))
         if self.cache:
             date = response.http_response.getheader('Date')
             date = timegm(parsedate(date))
@@ -188,16 +439,118 @@ class S3Storage(Storage):
 
     def _read(self, name, start_range=None, end_range=None):
         name = self._path(name)
+        return self._flights.do(('read', name, start_range, end_range),
+                                self._read_object, name, start_range,
+                                end_range)
+
+    def _read_object(self, name, start_range=None, end_range=None):
+        response = self.connection.get_stream(
+            self.bucket,
+            name,
+            self._range_headers(start_range, end_range)
+        )
+        valid_responses = [200]
+        if start_range is not None or end_range is not None:
+            valid_responses.append(206)
+        if response.http_response.status not in valid_responses:
+            raise S3Error(response.message)
+        headers = response.http_response.msg
+        chunks = response.iter_chunks()
+        if headers.get('Content-Encoding') == 'gzip':
+            chunks = compress.gunzip_chunks(chunks)
+        data = b''.join(chunks)
+        return data, headers.get('etag', None), headers.get('content-range', None)
+
+    def _cached_content(self, name):
+        """
+        Returns the ETag and contents of name from the content cache or None.
+        With CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_REVALIDATE set they're
+        checked against S3 first, which for an unchanged file only costs a
+        304 response.
+        """
+        path = self._path(name)
+        cached = self.content_cache.get(self._content_key(path),
+                                        self._known_etag(path))
+        if cached is None or not self._revalidate_content():
+            return cached
+        response = self.connection.get_stream(
+            self.bucket,
+            path,
+            {'If-None-Match': cached[0]}
+        )
+        try:
+            return self._revalidate_response(path, cached, response,
+                                             response.iter_chunks())
+        finally:
+            response.close()
+
+    def _content_key(self, path):
+        # Storages such as S3Storage and S3StorageStatic can share a content
+        # cache directory, so the bucket is part of the key.
+        return '%s/%s' % (self.bucket, path)
+
+    def _known_etag(self, path):
+        """
+        Returns the ETag of path from a HEAD request already made during the
+        current request, so a cached copy of a different version isn't used,
+        or None.
+        """
+        memo = request_memo()
+        if memo is None:
+            return None
+        response = memo.get(path)
+        if response is None or response.status != 200:
+            return None
+        return response.getheader('ETag')
+
+    def _revalidate_content(self):
+        return getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_REVALIDATE',
+            False
+        )
+
+    def _revalidate_response(self, path, cached, response, chunks):
+        """
+        Returns the cached ETag and contents if the conditional GET found them
+        unchanged, otherwise the new ones which are saved to the content
+        cache if they're small enough, or None if the file should be read as
+        usual.
+        """
+        http_response = response.http_response
+        if http_response.status == 304:
+            return cached
+        length = http_response.getheader('Content-Length')
+        if http_response.status != 200 or length is None or \
+           int(length) > self.content_cache.max_file_size:
+            self.content_cache.remove(self._content_key(path))
+            return None
+        if http_response.getheader('Content-Encoding') == 'gzip':
+            chunks = compress.gunzip_chunks(chunks)
+        etag = http_response.getheader('ETag')
+        data = b''.join(chunks)
+        self.content_cache.save(self._content_key(path), etag, data)
+        return etag, data
+
+    def _range_headers(self, start_range=None, end_range=None):
         headers, range_ = {}, None
         if start_range is not None and end_range is not None:
             range_ = '%s-%s' % (start_range, end_range)
         elif start_range is not None:
-            range_ = '%s' % start_range
+            range_ = '%s-' % start_range
         if range_ is not None:
             headers = {'Range': 'bytes=%s' % range_}
-        response = self.connection.get(self.bucket, name, headers)
+        return headers
+
+    def _read_response(self, response, start_range=None, end_range=None):
+        """
+        Returns the contents, ETag and Content-Range of a GET response, or
+        None for a range of a gzipped file, which can't be decompressed on
+        its own.
+        """
+        ranged = start_range is not None or end_range is not None
         valid_responses = [200]
-        if start_range is not None or end_range is not None:
+        if ranged:
             valid_responses.append(206)
         if response.http_response.status not in valid_responses:
             raise S3Error(response.message)
@@ -205,12 +558,191 @@ class S3Storage(Storage):
         data = response.object.data
 
         if headers.get('Content-Encoding') == 'gzip':
-            gzf = GzipFile(mode='rb', fileobj=StringIO(data))
-            data = gzf.read()
-            gzf.close()
+            if ranged:
+                return None
+            data = b''.join(compress.gunzip_chunks([data]))
 
         return data, headers.get('etag', None), headers.get('content-range', None)
 
+    def _read_block(self, name, start_range, end_range, etag=None):
+        """
+        Returns the bytes of a range of name, as stored on S3, and the headers
+        of the response.
+        """
+        name = self._path(name)
+        headers = self._range_headers(start_range, end_range)
+        if etag:
+            headers['If-Match'] = etag
+        response = self._flights.do(
+            ('block', name, start_range, end_range, etag),
+            self.connection.get, self.bucket, name, headers
+        )
+        if response.http_response.status not in (200, 206):
+            raise S3Error(response.message)
+        return response.object.data, response.http_response.msg
+
+    def _read_compressed(self, name, start_range=0, etag=None):
+        """
+        Yields the contents of name as stored on S3 from start_range to the
+        end, without decompressing them.
+        """
+        headers = {}
+        if start_range:
+            headers = self._range_headers(start_range)
+        if etag:
+            headers['If-Match'] = etag
+        response = self.connection.get_stream(self.bucket, self._path(name),
+                                              headers)
+        if response.http_response.status not in (200, 206):
+            response.close()
+            raise S3Error(response.message)
+        for chunk in response.iter_chunks():
+            yield chunk
+
+    def _read_stream(self, name, start_range=None, end_range=None,
+                     chunk_size=File.DEFAULT_CHUNK_SIZE):
+        """
+        Yields the contents of name in chunks of chunk_size bytes without
+        holding more than a chunk in memory, decompressing gzipped contents
+        on the way.
+        """
+        name = self._path(name)
+        response = self.connection.get_stream(
+            self.bucket,
+            name,
+            self._range_headers(start_range, end_range)
+        )
+        valid_responses = [200]
+        if start_range is not None or end_range is not None:
+            valid_responses.append(206)
+        if response.http_response.status not in valid_responses:
+            response.close()
+            raise S3Error(response.message)
+
+        chunks = response.iter_chunks(chunk_size)
+        if response.http_response.getheader('Content-Encoding') == 'gzip':
+            chunks = compress.gunzip_chunks(chunks)
+        buf = bytearray()
+        try:
+            for chunk in chunks:
+                buf.extend(chunk)
+                while len(buf) >= chunk_size:
+                    yield bytes(buf[:chunk_size])
+                    del buf[:chunk_size]
+            if buf:
+                yield bytes(buf)
+        finally:
+            response.close()
+
+    def download_to(self, name, path_or_fd):
+        """
+        Downloads name to a path or to a file descriptor open for writing,
+        fetching large files in ranges at the same time. Returns the number of
+        bytes written.
+        """
+        if isinstance(path_or_fd, int):
+            return self._download(name, path_or_fd)
+        fd = os.open(path_or_fd,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     getattr(os, 'O_BINARY', 0))
+        try:
+            return self._download(name, fd)
+        finally:
+            os.close(fd)
+
+    def _download(self, name, fd):
+        part_size = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE',
+            multipart.DEFAULT_PART_SIZE
+        )
+        concurrency = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CONCURRENCY',
+            multipart.DEFAULT_CONCURRENCY
+        )
+        path = self._path(name)
+        # The first range also tells us the size and ETag of the file.
+        response = self.connection.get_stream(
+            self.bucket,
+            path,
+            self._range_headers(0, part_size - 1)
+        )
+        http_response = response.http_response
+        if http_response.status == 416:
+            # Zero length files can't be ranged
+            os.ftruncate(fd, 0)
+            return 0
+        if http_response.status not in (200, 206):
+            raise S3Error(response.message)
+
+        if http_response.getheader('Content-Encoding') == 'gzip':
+            # Ranges of gzipped contents can't be decompressed on their own
+            # so stream the whole file instead.
+            response.close()
+            written = 0
+            for chunk in self._read_stream(name):
+                pwrite(fd, chunk, written)
+                written += len(chunk)
+            os.ftruncate(fd, written)
+            return written
+
+        if http_response.status == 200:
+            size = int(http_response.getheader('Content-Length'))
+        else:
+            size = int(http_response.getheader('Content-Range').split('/')[1])
+        etag = http_response.getheader('ETag')
+        os.ftruncate(fd, size)
+        timeouts = current_timeouts()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = []
+        try:
+            if http_response.status == 206:
+                for start in range(part_size, size, part_size):
+                    futures.append(executor.submit(
+                        call_with_timeouts, timeouts, self._download_range,
+                        path, fd, start, min(start + part_size, size) - 1,
+                        size, etag
+                    ))
+            self._write_response(path, response, fd, 0,
+                                 min(part_size, size))
+            for future in futures:
+                future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+        return size
+
+    def _download_range(self, path, fd, start, end, size, etag):
+        headers = self._range_headers(start, end)
+        if etag:
+            # Fail instead of mixing ranges of different versions of the file.
+            headers['If-Match'] = etag
+        response = self.connection.get_stream(self.bucket, path, headers)
+        if response.http_response.status != 206:
+            response.close()
+            raise S3Error(response.message)
+        content_range = response.http_response.getheader('Content-Range')
+        if content_range != 'bytes %d-%d/%d' % (start, end, size):
+            response.close()
+            raise S3Error("Unexpected range '%s' of '%s'." % (content_range, path))
+        self._write_response(path, response, fd, start, end - start + 1)
+
+    def _write_response(self, path, response, fd, offset, length):
+        written = 0
+        try:
+            for chunk in response.iter_chunks():
+                pwrite(fd, chunk, offset + written)
+                written += len(chunk)
+        finally:
+            response.close()
+        if written != length:
+            raise S3Error("Expected %d bytes of '%s' from %d but got %d." % (
+                length, path, offset, written))
+
     def _save(self, name, content):
         self._put_file(name, content)
         return name
@@ -218,10 +750,43 @@ class S3Storage(Storage):
     def delete(self, name):
         name = self._path(name)
         response = self.connection.delete(self.bucket, name)
+        self._delete_response(name, response)
+
+    def _delete_response(self, name, response):
+        self._forget_head(name)
         if response.http_response.status != 204:
             raise S3Error(response.message)
+        if self.content_cache:
+            self.content_cache.remove(self._content_key(name))
         if self.cache:
             self.cache.remove(name)
+            self.cache.save_missing(name)
+
+    def _head(self, name, force_check=False):
+        """
+        Makes a HEAD request for name, sharing the response with any
+        concurrent HEAD requests for it. Within a request handled by the
+        ThreadLocals middleware a 200 or 404 response is remembered until the
+        end of the request unless force_check is True.
+        """
+        memo = request_memo()
+        if memo is not None and not force_check:
+            response = memo.get(name)
+            if response is not None:
+                return response
+        response = self._flights.do(('head', name),
+                                    self.connection._make_request, 'HEAD',
+                                    self.bucket, name)
+        if memo is not None and response.status in (200, 404):
+            # Errors that outlasted the retries may not last for the rest of
+            # the request.
+            memo[name] = response
+        return response
+
+    def _forget_head(self, name):
+        memo = request_memo()
+        if memo is not None:
+            memo.pop(name, None)
 
     def exists(self, name, force_check=False):
         if not name:
@@ -231,10 +796,15 @@ class S3Storage(Storage):
             exists = self.cache.exists(name)
             if exists is not None:
                 return exists
-        response = self.connection._make_request('HEAD', self.bucket, name)
+        response = self._head(name, force_check)
+        return self._exists_response(name, response)
+
+    def _exists_response(self, name, response):
         exists = response.status == 200
         if self.cache and exists:
             self._store_in_cache(name, response)
+        elif self.cache and response.status == 404:
+            self.cache.save_missing(name)
         return exists
 
     def size(self, name, force_check=False):
@@ -243,7 +813,10 @@ class S3Storage(Storage):
             size = self.cache.size(name)
             if size is not None:
                 return size
-        response = self.connection._make_request('HEAD', self.bucket, name)
+        response = self._head(name, force_check)
+        return self._size_response(name, response)
+
+    def _size_response(self, name, response):
         content_length = response.getheader('Content-Length')
         if self.cache:
             self._store_in_cache(name, response)
@@ -255,14 +828,135 @@ class S3Storage(Storage):
             last_modified = self.cache.modified_time(name)
             if last_modified:
                 return datetime.fromtimestamp(last_modified)
-        response = self.connection._make_request('HEAD', self.bucket, name)
+        response = self._head(name, force_check)
+        return self._modified_time_response(name, response)
+
+    def _modified_time_response(self, name, response):
         if response.status == 404:
+            if self.cache:
+                self.cache.save_missing(name)
             raise S3Error("Cannot find the file specified: '%s'" % name)
         last_modified = timegm(parsedate(response.getheader('Last-Modified')))
         if self.cache:
             self._store_in_cache(name, response)
         return datetime.fromtimestamp(last_modified)
 
+    def stat_many(self, names):
+        """
+        Returns a dict of each of names to a dict of its ``size`` and
+        ``modified_time``, or to None if it doesn't exist.
+
+        Cached metadata, including which files are known not to exist, is
+        looked up all at once. The rest is found by listing directories with
+        several of the files in and with concurrent HEAD requests for the
+        others, and is then saved to the cache together.
+        """
+        paths = dict((name, self._path(name)) for name in names)
+        found = {}
+        if self.cache:
+            found = self.cache.get_many(list(set(paths.values())))
+            # Skip placeholders for files that are still being uploaded
+            found = dict((path, values) for path, values in found.items()
+                         if values is None or values['mtime'])
+        uncached = [path for path in set(paths.values()) if path not in found]
+        fetched, missing = self._stat_uncached(uncached)
+        if self.cache:
+            if fetched:
+                self.cache.save_many(fetched)
+            if missing:
+                self.cache.save_missing_many(missing)
+        found.update(fetched)
+        stats = {}
+        for name, path in paths.items():
+            values = found.get(path)
+            if values is not None:
+                values = {
+                    'size': values['size'],
+                    'modified_time': datetime.fromtimestamp(values['mtime'])
+                }
+            stats[name] = values
+        return stats
+
+    def _stat_uncached(self, paths):
+        """
+        Returns a dict of paths to dicts of their ``size`` and ``mtime`` and a
+        list of the paths that don't exist.
+        """
+        directories = {}
+        for path in paths:
+            directories.setdefault(path.rpartition('/')[0], []).append(path)
+        found, missing, to_head = {}, [], []
+        for directory, dir_paths in directories.items():
+            if len(dir_paths) < STAT_LIST_THRESHOLD:
+                to_head.extend(dir_paths)
+                continue
+            listed, complete = self._stat_directory(directory)
+            # Keys are listed in order, so anything before the last one on the
+            # first page of a large directory is missing too.
+            last = max(listed) if listed else ''
+            for path in dir_paths:
+                if path in listed:
+                    found[path] = listed[path]
+                elif complete or path < last:
+                    missing.append(path)
+                else:
+                    # Beyond the first page of a large directory
+                    to_head.append(path)
+
+        if len(to_head) > 1:
+            timeouts = current_timeouts()
+            executor = ThreadPoolExecutor(max_workers=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_STAT_CONCURRENCY',
+                DEFAULT_STAT_CONCURRENCY
+            ))
+            try:
+                responses = list(executor.map(
+                    lambda path: call_with_timeouts(timeouts, self._head,
+                                                    path),
+                    to_head
+                ))
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            responses = [self._head(path) for path in to_head]
+        for path, response in zip(to_head, responses):
+            if response.status == 200:
+                found[path] = {
+                    'size': int(response.getheader('Content-Length') or 0),
+                    'mtime': timegm(parsedate(
+                        response.getheader('Last-Modified')))
+                }
+            elif response.status == 404:
+                missing.append(path)
+            else:
+                raise S3Error("Cannot stat '%s': %03d %s" % (
+                    path, response.status, response.reason))
+        return found, missing
+
+    def _stat_directory(self, directory):
+        """
+        Lists the files directly in directory, returning a dict of their paths
+        to dicts of their ``size`` and ``mtime`` and whether all of them were
+        listed.
+        """
+        prefix = directory and directory + '/'
+        response = self._flights.do(('list', prefix),
+                                    self.connection.list_bucket, self.bucket,
+                                    options={'prefix': prefix,
+                                             'delimiter': '/'})
+        if response.http_response.status != 200:
+            return {}, False
+        listed = {}
+        for entry in response.entries:
+            mtime = datetime.strptime(entry.last_modified[:19],
+                                      '%Y-%m-%dT%H:%M:%S')
+            listed[entry.key] = {
+                'size': entry.size,
+                'mtime': timegm(mtime.timetuple())
+            }
+        return listed, not response.is_truncated
+
     def url(self, name):
         if self.base_url is None:
             raise ValueError("This file is not accessible via a URL.")
@@ -285,12 +979,20 @@ class S3Storage(Storage):
         return urljoin(url, iri_to_uri(name))
 
     def listdir(self, path):
+        path, options = self._listdir_options(path)
+        response = self._flights.do(('list', path),
+                                    self.connection.list_bucket, self.bucket,
+                                    options=options)
+        return self._listdir_response(path, response)
+
+    def _listdir_options(self, path):
         path = self._path(path)
         if not path.endswith('/'):
             path = path+'/'
+        return path, {'prefix': path, 'delimiter': '/'}
+
+    def _listdir_response(self, path, response):
         directories, files = [], []
-        options = {'prefix': path, 'delimiter': '/'}
-        response = self.connection.list_bucket(self.bucket, options=options)
         for prefix in response.common_prefixes:
             directories.append(prefix.prefix.replace(path, '').strip('/'))
         for entry in response.entries:
@@ -305,7 +1007,7 @@ class S3Storage(Storage):
         return name
 
 
-class S3StorageFile(File):
+class S3StorageFile(AsyncStorageFileMixin, File):
     def __init__(self, name, storage, mode):
         self.name = name
         self._storage = storage
@@ -313,23 +1015,308 @@ class S3StorageFile(File):
         self._is_dirty = False
         self.file = StringIO()
         self.start_range = 0
+        block_size = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE',
+            DEFAULT_BLOCK_SIZE
+        )
+        self._buffer = None
+        if block_size:
+            self._buffer = ReadAheadBuffer(
+                self._fetch_block,
+                block_size,
+                getattr(
+                    settings,
+                    'CUDDLYBUDDLY_STORAGE_S3_READ_AHEAD',
+                    DEFAULT_MAX_READ_AHEAD
+                )
+            )
+        self._etag = None
+        self._gzip = None
+        self._content = None
+        self._content_checked = False
 
     @property
     def size(self):
+        """
+        The size of the file's contents, which for a gzipped file is its
+        decompressed size rather than the Content-Length S3 has for it.
+        """
         if not hasattr(self, '_size'):
-            self._size = self._storage.size(self.name)
+            if self._cached_content() is not None:
+                self._size = len(self._content)
+            elif self._gzip is not None:
+                self._size = self._gzip_size()
+            elif self._storage._may_be_gzipped(self.name):
+                self._size = self._head_size(
+                    self._storage._head(self._storage._path(self.name))
+                )
+            else:
+                self._size = self._storage.size(self.name)
         return self._size
 
+    def _head_size(self, response):
+        """
+        Returns the size of the file from the response to a HEAD request,
+        opening a GzipView of it if it turns out to be gzipped.
+        """
+        if response.status == 200 and \
+           response.getheader('Content-Encoding') == 'gzip':
+            self._open_gzip(response.getheader('ETag'),
+                            int(response.getheader('Content-Length')))
+            return self._gzip_size()
+        return self._storage._size_response(self._storage._path(self.name),
+                                            response)
+
+    def _gzip_size(self):
+        """
+        Returns the decompressed size of a gzipped file from the end of the
+        gzip stream, which stores it modulo 2**32, so files of 4 GB or more
+        are only reported correctly if it has clearly wrapped.
+        """
+        if self._gzip.size is not None:
+            return self._gzip.size
+        data, headers = self._storage._read_block(
+            self.name,
+            self._compressed_size - 4,
+            self._compressed_size - 1,
+            self._etag
+        )
+        size = struct.unpack('<I', data)[0]
+        if size < (self._compressed_size - 1024) // 2:
+            # Deflate barely expands even incompressible data, so the size
+            # must have wrapped around 2**32. Count it by decompressing the
+            # whole file instead.
+            size = 0
+            for chunk in compress.gunzip_chunks(self._storage._read_compressed(
+                    self.name, 0, self._etag)):
+                size += len(chunk)
+        return size
+
+    def _cached_content(self):
+        """
+        Returns the contents of the file from the storage's content cache or
+        None if they aren't cached.
+        """
+        if self._storage.content_cache is None or self._is_dirty:
+            return None
+        if not self._content_checked:
+            self._use_cached(self._storage._cached_content(self.name))
+        return self._content
+
+    def _use_cached(self, cached):
+        self._content_checked = True
+        if cached is not None:
+            self._etag, self._content = cached
+
+    def _save_content(self, etag, data):
+        """
+        Saves the contents of the file to the storage's content cache if
+        they're small enough, returning True if they were.
+        """
+        cache = self._storage.content_cache
+        if cache is None or not etag or len(data) > cache.max_file_size:
+            return False
+        path = self._storage._path(self.name)
+        cache.save(self._storage._content_key(path), etag, data)
+        self._content = data
+        self._content_checked = True
+        return True
+
+    def _read_cached(self, num_bytes=None):
+        pos = self.start_range
+        if pos < 0:
+            pos = max(pos + len(self._content), 0)
+        end = pos + num_bytes if num_bytes else len(self._content)
+        data = bytes(self._content[pos:end])
+        self._size = len(self._content)
+        self.start_range = pos + len(data)
+        self.file = StringIO(data)
+        return data
+
     def _empty_read(self):
         self.file = StringIO(b'')
         return self.file.getvalue()
 
     def read(self, num_bytes=None):
+        if self._cached_content() is not None:
+            return self._read_cached(num_bytes)
+        if self._buffer is not None:
+            if num_bytes:
+                return self._buffered_read(num_bytes)
+            if self.start_range or self._gzip is not None:
+                return self._read_fetched()
+        if self._gzip is not None:
+            return self._read_fetched(num_bytes)
+        args = self._read_args(num_bytes)
+        if args is None:
+            return self._empty_read()
+
+        try:
+            data, etags, content_range = self._storage._read(self.name, *args)
+        except S3Error as e:
+            # Catch InvalidRange for 0 length reads. Perhaps we should be
+            # catching all kinds of exceptions...
+            if '<Code>InvalidRange</Code>' in '%s' % e:
+                return self._empty_read()
+            raise
+        if not args:
+            self._save_content(etags, data)
+        return self._read_result(data, content_range)
+
+    def _buffered_read(self, num_bytes):
+        pos = self.start_range
+        if pos < 0:
+            pos += self.size
+        data = self._buffer.read(pos, num_bytes)
+        if self._buffer.size is not None:
+            self._size = self._buffer.size
+        self.start_range = pos + len(data)
+        self.file = StringIO(data)
+        return data
+
+    def _read_fetched(self, num_bytes=None):
+        """
+        Reads num_bytes, or to the end, from the current position with
+        _fetch_block.
+        """
+        pos = self.start_range
+        if pos < 0:
+            pos += self.size
+        end = None
+        if num_bytes:
+            end = pos + num_bytes - 1
+        data, size = self._fetch_block(pos, end)
+        if size is not None:
+            self._size = size
+        self.start_range = pos + len(data)
+        self.file = StringIO(data)
+        return data
+
+    def read_ranges(self, ranges):
+        """
+        Reads a list of ``(offset, length)`` ranges without moving the
+        position of the file, returning a memoryview of each.
+
+        Ranges close enough together are fetched with a single request and
+        the requests are made at the same time.
+        """
+        merged = coalesce_ranges(ranges, getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_RANGE_GAP',
+            DEFAULT_RANGE_GAP
+        ))
+        results = [None] * len(merged)
+        if self._etag is None and len(merged) > 1:
+            # Find out the ETag and whether the file is gzipped first so the
+            # rest of the ranges can be checked against it.
+            results[0] = self._fetch_block(merged[0][0], merged[0][1] - 1)
+        pending = [i for i, result in enumerate(results) if result is None]
+        if len(pending) == 1:
+            i = pending[0]
+            results[i] = self._fetch_block(merged[i][0], merged[i][1] - 1)
+        elif pending:
+            timeouts = current_timeouts()
+            executor = ThreadPoolExecutor(max_workers=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CONCURRENCY',
+                multipart.DEFAULT_CONCURRENCY
+            ))
+            try:
+                futures = [
+                    executor.submit(call_with_timeouts, timeouts,
+                                    self._fetch_block, merged[i][0],
+                                    merged[i][1] - 1)
+                    for i in pending
+                ]
+                for i, future in zip(pending, futures):
+                    results[i] = future.result()
+            finally:
+                executor.shutdown(wait=True)
+
+        views = [memoryview(b'')] * len(ranges)
+        for (start, end, indexes), (data, size) in zip(merged, results):
+            if size is not None:
+                self._size = size
+            data = memoryview(data)
+            for i in indexes:
+                offset, length = ranges[i]
+                views[i] = data[offset - start:offset - start + length]
+        return views
+
+    def _fetch_block(self, start_range, end_range):
+        """
+        Fetches a range of the file, to the end if end_range is None,
+        returning it along with the size of the file if it's known.
+        """
+        if self._cached_content() is not None:
+            if end_range is None:
+                end_range = len(self._content)
+            else:
+                end_range += 1
+            return bytes(self._content[start_range:end_range]), \
+                len(self._content)
+        if self._gzip is not None:
+            return self._gzip.read(start_range, end_range), self._gzip.size
+        try:
+            data, headers = self._storage._read_block(
+                self.name,
+                start_range,
+                end_range,
+                self._etag
+            )
+        except S3Error as e:
+            # Zero length files can't be ranged
+            if '<Code>InvalidRange</Code>' in '%s' % e:
+                return b'', None
+            raise
+        self._etag = headers.get('etag', None)
+        content_range = headers.get('content-range', None)
+        if content_range is not None:
+            size = int(content_range.split('/', 1)[1])
+        else:
+            size = int(headers.get('content-length'))
+        if headers.get('Content-Encoding') == 'gzip':
+            self._open_gzip(self._etag, size)
+        cache = self._storage.content_cache
+        if cache is not None and size <= cache.max_file_size:
+            # Small files are cached whole, so fetch the rest of them first.
+            if self._gzip is not None:
+                data = self._gzip.read(0)
+            elif start_range != 0 or len(data) != size:
+                data = self._storage._read_block(self.name, 0, size - 1,
+                                                 self._etag)[0]
+            if self._save_content(self._etag, data):
+                return self._fetch_block(start_range, end_range)
+        if self._gzip is not None:
+            return self._fetch_block(start_range, end_range)
+        return data, size
+
+    def _open_gzip(self, etag, compressed_size):
+        # Ranges refer to the gzipped contents, so read the decompressed
+        # contents through a view of them instead.
+        name = self.name
+        self._etag = etag
+        self._compressed_size = compressed_size
+        self._gzip = compress.GzipView(
+            lambda offset: self._storage._read_compressed(name, offset, etag),
+            getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_GZIP_CHECKPOINT_INTERVAL',
+                compress.DEFAULT_CHECKPOINT_INTERVAL
+            )
+        )
+
+    def _read_args(self, num_bytes=None):
+        """
+        Returns the range to request for a read or None if there is nothing
+        left to read.
+        """
         # Reading past the file size results in a 416 (InvalidRange) error from
         # S3, but accessing the size when not using chunked reading causes an
         # unnecessary HEAD call.
         if self.start_range and self.start_range >= self.size:
-            return self._empty_read()
+            return None
 
         args = []
 
@@ -341,15 +1328,9 @@ class S3StorageFile(File):
             args = [self.start_range + offset, self.start_range + num_bytes - 1 + offset]
         elif self.start_range:
             args = [self.start_range, '']
+        return args
 
-        try:
-            data, etags, content_range = self._storage._read(self.name, *args)
-        except S3Error as e:
-            # Catch InvalidRange for 0 length reads. Perhaps we should be
-            # catching all kinds of exceptions...
-            if '<Code>InvalidRange</Code>' in '%s' % e:
-                return self._empty_read()
-            raise
+    def _read_result(self, data, content_range):
         if content_range is not None:
             current_range, size = content_range.split(' ', 1)[1].split('/', 1)
             start_range, end_range = current_range.split('-', 1)
@@ -358,18 +1339,146 @@ class S3StorageFile(File):
         self.file = StringIO(data)
         return self.file.getvalue()
 
+    def chunks(self, chunk_size=None):
+        """
+        Streams the file from S3 instead of reading each chunk with a separate
+        request.
+        """
+        if self._is_dirty:
+            for chunk in super(S3StorageFile, self).chunks(chunk_size):
+                yield chunk
+            return
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        self.start_range = 0
+        if self._cached_content() is not None:
+            for i in range(0, len(self._content), chunk_size):
+                chunk = bytes(self._content[i:i + chunk_size])
+                self.start_range += len(chunk)
+                yield chunk
+            return
+        try:
+            for chunk in self._storage._read_stream(self.name,
+                                                    chunk_size=chunk_size):
+                self.start_range += len(chunk)
+                yield chunk
+        except S3Error as e:
+            # Zero length files can't be ranged and don't have any chunks
+            if '<Code>InvalidRange</Code>' not in '%s' % e:
+                raise
+
     def write(self, content):
+        """
+        Appends to the file, which is spooled to disk once it gets large.
+        Large files that won't be gzipped are uploaded in parts while they're
+        still being written.
+        """
         if 'w' not in self.mode:
             raise AttributeError("File was opened for read-only access.")
-        self.file = StringIO(content)
-        self._is_dirty = True
+        if not self._is_dirty:
+            self.file = self._spooled_file()
+            self._is_dirty = True
+            self._written = 0
+            self._upload = None
+            self._reset_buffer()
+        self.file.write(content)
+        self._written += len(content)
+        self._upload_parts()
+
+    def _spooled_file(self):
+        return SpooledTemporaryFile(max_size=getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_SPOOL_SIZE',
+            DEFAULT_SPOOL_SIZE
+        ))
+
+    def _upload_parts(self):
+        """
+        Uploads the parts written so far once the file is large enough for a
+        multipart upload.
+        """
+        part_size = max(getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE',
+            multipart.DEFAULT_PART_SIZE
+        ), multipart.MIN_PART_SIZE)
+        if self.file.tell() < part_size:
+            return
+        if self._upload is None:
+            threshold = getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD',
+                multipart.DEFAULT_THRESHOLD
+            )
+            if threshold is None or self._written <= threshold:
+                return
+            name = self._storage._path(self.name)
+            headers = self._storage._put_headers(name)
+            if headers['Content-Type'] in self._storage._gzip_content_types():
+                # The whole file is needed to decide whether to gzip it.
+                return
+            self._placeholder = self._storage._save_placeholder(name)
+            self._upload = self._storage._multipart_writer(name, headers)
+            self._check_upload(self._upload.start())
+
+        self.file.seek(0)
+        while True:
+            data = self.file.read(part_size)
+            if len(data) < part_size:
+                break
+            self._check_upload(self._upload.write(data))
+        # Start a new spool with what's left over for the next part.
+        self.file.close()
+        self.file = self._spooled_file()
+        self.file.write(data)
+
+    def _check_upload(self, failed):
+        if failed is not None:
+            if self._placeholder:
+                self._storage.cache.remove(self._upload.key)
+            self._upload = None
+            self._is_dirty = False
+            raise S3Error(failed.message)
+
+    def _complete_upload(self):
+        self.file.seek(0)
+        data = self.file.read()
+        if data:
+            self._check_upload(self._upload.write(data))
+        response = self._upload.complete()
+        upload, self._upload = self._upload, None
+        self._storage._finish_put(upload.key, self.file, response,
+                                  self._written, 0, self._placeholder)
+
+    def _reset_buffer(self):
+        if self._buffer is not None:
+            self._buffer.clear()
+            self._buffer.size = None
+        self._etag = None
+        if self._gzip is not None:
+            self._gzip.close()
+            self._gzip = None
+        self._content = None
+        self._content_checked = False
 
     def close(self):
         if self._is_dirty:
-            self._storage._put_file(self.name, self.file)
-            self._size = len(self.file.getvalue())
+            if self._upload is not None:
+                self._complete_upload()
+            else:
+                self._storage._put_file(self.name, self.file)
+            self._size = self._written
+            self._is_dirty = False
+        if self._gzip is not None:
+            self._gzip.close()
+        self._release_content()
         self.file.close()
 
+    def _release_content(self):
+        # Cached contents may be memory mapped, and the mapping is only
+        # closed once nothing references it.
+        self._content = None
+        self._content_checked = False
+
     def seek(self, pos, mode=0):
         self.file.seek(pos, mode)
         if mode == 0:
@@ -1,32 +1,58 @@
 import base64
 from datetime import datetime, timedelta
+from gzip import GzipFile
 try:
     import http.client as httplib # Python 3
 except ImportError:
     import httplib # Python 2
 import os
+import shutil
+import socket
+import ssl
 try:
     from io import BytesIO as StringIO # Python 3
 except ImportError:
     from StringIO import StringIO # Python 2
-from time import sleep
+import sys
+import tempfile
+import threading
+from time import sleep, time
+from unittest import skipIf
 try:
     from urllib import parse as urlparse # Python 3
 except ImportError:
     import urlparse # Python 2
 from zipfile import ZipFile
 from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import SuspiciousFileOperation
 from django.core.files.base import ContentFile
 from django.core.management import call_command
 from django.forms.widgets import Media
+from django.http import HttpResponse
 from django.template import Context, Template, TemplateSyntaxError
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 from django.test.utils import override_settings
 from django.utils.encoding import force_text
 from django.utils.http import urlquote
 from cuddlybuddly.storage.s3 import lib
+from cuddlybuddly.storage.s3.cache import FILE_MODE, ChainCache, \
+    DjangoCache, FileSystemCache, MemoryCache
+from cuddlybuddly.storage.s3.compress import CompressionHistory, \
+    GzipStream, GzipView, gunzip_chunks, should_gzip
+from cuddlybuddly.storage.s3.contentcache import ContentCache
 from cuddlybuddly.storage.s3.exceptions import S3Error
-from cuddlybuddly.storage.s3.storage import S3Storage
+from cuddlybuddly.storage.s3.middleware import ThreadLocals, \
+    set_request_memo
+from cuddlybuddly.storage.s3.multipart import MIN_PART_SIZE, get_part_size
+from cuddlybuddly.storage.s3.pool import ConnectionPool, HTTPSConnection, \
+    TLSSessionCache
+from cuddlybuddly.storage.s3.ratelimit import AdaptiveRateLimiter
+from cuddlybuddly.storage.s3.readahead import ReadAheadBuffer, \
+    coalesce_ranges
+from cuddlybuddly.storage.s3.retry import RetryBudget, RetryPolicy
+from cuddlybuddly.storage.s3.singleflight import SingleFlight
+from cuddlybuddly.storage.s3.storage import S3Storage, S3StorageFile
 from cuddlybuddly.storage.s3.utils import CloudFrontURLs, create_signed_url
 
 
@@ -242,6 +268,137 @@ class S3StorageTests(TestCase):
 
         default_storage.delete(filename)
 
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD=1,
+                       CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE=1)
+    def test_multipart_upload(self):
+        filename = 'testsdir/filemultipart.bin'
+        data = os.urandom(MIN_PART_SIZE * 2 + 100)
+        filename = default_storage.save(filename, ContentFile(data))
+        self.assertEqual(default_storage.size(filename), len(data))
+        file_ = default_storage.open(filename)
+        self.assertEqual(file_.read(), data)
+        file_.close()
+        default_storage.delete(filename)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=(),
+                       CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE=1024)
+    def test_download_to(self):
+        filename = 'testsdir/filedownload.txt'
+        data = os.urandom(1024 * 5 + 100)
+        filename = default_storage.save(filename, ContentFile(data))
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual(default_storage.download_to(filename, path), len(data))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            os.remove(path)
+        default_storage.delete(filename)
+
+    def test_read_ranges(self):
+        filename = 'testsdir/fileranges.bin'
+        data = os.urandom(1024 * 100)
+        filename = default_storage.save(filename, ContentFile(data))
+        ranges = [(0, 10), (20, 10), (1024 * 99, 2048), (50000, 0)]
+        file_ = default_storage.open(filename)
+        views = file_.read_ranges(ranges)
+        self.assertEqual([bytes(v) for v in views],
+                         [data[0:10], data[20:30], data[1024 * 99:], b''])
+        self.assertEqual(file_.tell(), 0)
+        default_storage.delete(filename)
+
+    def test_content_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        connection = default_storage.connection
+        default_storage.content_cache = ContentCache(cache_dir)
+        try:
+            filename = 'testsdir/filecontentcache.bin'
+            data = os.urandom(1024 * 100)
+            filename = default_storage.save(filename, ContentFile(data))
+            self.assertEqual(default_storage.open(filename).read(10), data[:10])
+            # Served from the cache without touching S3
+            default_storage.connection = None
+            file_ = default_storage.open(filename)
+            file_.seek(1024 * 50)
+            self.assertEqual(file_.read(), data[1024 * 50:])
+            default_storage.connection = connection
+            default_storage.delete(filename)
+            self.assertEqual(default_storage.content_cache.get(filename), None)
+        finally:
+            default_storage.connection = connection
+            default_storage.content_cache = None
+            shutil.rmtree(cache_dir)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_REVALIDATE=True)
+    def test_content_cache_revalidate(self):
+        cache_dir = tempfile.mkdtemp()
+        default_storage.content_cache = ContentCache(cache_dir)
+        try:
+            filename = default_storage.save('testsdir/filerevalidate.txt',
+                                            ContentFile(b'Lorem'))
+            self.assertEqual(default_storage.open(filename).read(), b'Lorem')
+            self.assertEqual(default_storage.open(filename).read(), b'Lorem')
+            # Changed without going through the storage
+            default_storage.connection.put(default_storage.bucket, filename,
+                                           b'Ipsum')
+            self.assertEqual(default_storage.open(filename).read(), b'Ipsum')
+            self.assertEqual(
+                default_storage.content_cache.get(filename)[1],
+                b'Ipsum'
+            )
+            default_storage.delete(filename)
+        finally:
+            default_storage.content_cache = None
+            shutil.rmtree(cache_dir)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD=1,
+                       CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE=1)
+    def test_multipart_write(self):
+        filename = 'testsdir/filemultipartwrite.bin'
+        data = [os.urandom(1024 * 1024) for i in range(11)]
+        file_ = default_storage.open(filename, 'wb')
+        for chunk in data:
+            file_.write(chunk)
+        file_.close()
+        self.assertEqual(file_.size, len(data) * 1024 * 1024)
+        file_ = default_storage.open(filename)
+        self.assertEqual(file_.read(), b''.join(data))
+        file_.close()
+        default_storage.delete(filename)
+
+    def test_chunked_gzip_read(self):
+        ct_backup = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES', None)
+        settings.CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES = ('text/css',)
+
+        filename = 'testsdir/filechunkedgzip.css'
+        filename = default_storage.save(filename, UnicodeContentFile(b'Lorem ipsum ' * 512))
+
+        file_ = default_storage.open(filename)
+        chunks = list(file_.chunks(1024))
+        self.assertEqual([len(c) for c in chunks], [1024] * 6)
+        self.assertEqual(b''.join(chunks), b'Lorem ipsum ' * 512)
+
+        default_storage.delete(filename)
+
+        if ct_backup is not None:
+            settings.CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES = ct_backup
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=('text/css',))
+    def test_gzip_seek_from_end(self):
+        filename = 'testsdir/filegzipseek.css'
+        data = b''.join(b'.c%d { color: red; }\n' % i for i in range(5000))
+        filename = default_storage.save(filename, ContentFile(data))
+        self.assertTrue(default_storage.size(filename) < len(data))
+        file_ = default_storage.open(filename)
+        # The size is the decompressed size even before anything is read
+        self.assertEqual(file_.size, len(data))
+        file_.seek(-20, 2)
+        self.assertEqual(file_.read(20), data[-20:])
+        self.assertEqual(file_.tell(), len(data))
+        file_.close()
+        default_storage.delete(filename)
+
     def test_chunked_zipfile_read(self):
         """
         A zip file's central directory is located at the end of the file and
@@ -266,6 +423,1170 @@ class S3StorageTests(TestCase):
         default_storage.delete(filename)
 
 
+class DummyConnection(object):
+    def __init__(self):
+        # An idle socket that is never readable, so it always looks alive
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+        self.sock = None
+
+
+@skipIf(sys.version_info < (3, 7), 'Requires asyncio')
+class AsyncConnectionTests(TestCase):
+    def test_async_connection(self):
+        import asyncio
+        from cuddlybuddly.storage.s3.aio import AsyncAWSAuthConnection
+
+        async def run():
+            conn = AsyncAWSAuthConnection(
+                settings.AWS_ACCESS_KEY_ID,
+                settings.AWS_SECRET_ACCESS_KEY,
+                calling_format=settings.AWS_CALLING_FORMAT
+            )
+            bucket = settings.AWS_STORAGE_BUCKET_NAME
+            names = ['testsdir/async%s.txt' % i for i in range(10)]
+            responses = await asyncio.gather(*[
+                conn.put(bucket, name, b'Lorem ipsum') for name in names
+            ])
+            self.assertEqual([r.http_response.status for r in responses],
+                             [200] * 10)
+            response = await conn.get(bucket, names[0])
+            self.assertEqual(response.object.data, b'Lorem ipsum')
+            response = await conn.head(bucket, names[0])
+            self.assertEqual(
+                response.http_response.getheader('Content-Length'),
+                '11'
+            )
+            response = await conn.list_bucket(
+                bucket,
+                {'prefix': 'testsdir/async'}
+            )
+            self.assertEqual(sorted(e.key for e in response.entries), names)
+            await asyncio.gather(*[conn.delete(bucket, name) for name in names])
+            response = await conn.head(bucket, names[0])
+            self.assertEqual(response.http_response.status, 404)
+            await conn.close()
+
+        asyncio.run(run())
+
+    def test_async_storage(self):
+        import asyncio
+
+        async def run():
+            filename = await default_storage.asave(
+                'testsdir/fileasync.txt',
+                UnicodeContentFile(b'Lorem ipsum dolor sit amet')
+            )
+            self.assertTrue(await default_storage.aexists(filename))
+            self.assertEqual(await default_storage.asize(filename), 26)
+            now = datetime.now()
+            delta = timedelta(minutes=5)
+            mtime = await default_storage.amodified_time(filename)
+            self.assertTrue(now - delta < mtime < now + delta)
+            self.assertEqual(
+                await default_storage.alistdir('testsdir'),
+                ([], ['fileasync.txt'])
+            )
+            file_ = await default_storage.aopen(filename)
+            self.assertEqual(await file_.aread(11), b'Lorem ipsum')
+            self.assertEqual(await file_.aread(), b' dolor sit amet')
+            await default_storage.adelete(filename)
+            self.assertTrue(not await default_storage.aexists(filename))
+
+        asyncio.run(run())
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=('text/css',))
+    def test_async_gzip_read(self):
+        import asyncio
+
+        async def run():
+            data = b''.join(b'.c%d { color: red; }\n' % i for i in range(5000))
+            filename = await default_storage.asave('testsdir/fileasyncgzip.css',
+                                                   ContentFile(data))
+            file_ = await default_storage.aopen(filename)
+            self.assertEqual(await file_.aread(11), data[:11])
+            self.assertEqual(await file_.aread(20), data[11:31])
+            self.assertEqual(file_.tell(), 31)
+            file_.seek(100000)
+            self.assertEqual(await file_.aread(50), data[100000:100050])
+            self.assertEqual(await file_.aread(), data[100050:])
+            file_.close()
+            await default_storage.adelete(filename)
+
+        asyncio.run(run())
+
+    def test_async_cache_off_loop(self):
+        import asyncio
+
+        storage = S3Storage()
+        storage.cache = ThreadCheckingCache()
+        storage._async_connection = AsyncHeadConnection()
+
+        async def run():
+            self.assertTrue(await storage.aexists('file.txt'))
+            self.assertEqual(await storage.asize('file.txt'), 11)
+            await storage.amodified_time('file.txt')
+            self.assertTrue(not await storage.aexists('missing.txt'))
+            await storage.adelete('file.txt')
+            self.assertTrue(not await storage.aexists('file.txt'))
+
+        asyncio.run(run())
+        self.assertEqual(storage.cache.blocking, [])
+        self.assertEqual(storage._async_connection.requests, [
+            ('HEAD', 'file.txt'), ('HEAD', 'missing.txt'),
+            ('DELETE', 'file.txt')
+        ])
+
+    def test_async_content_cache_off_loop(self):
+        import asyncio
+
+        cache_dir = tempfile.mkdtemp()
+        storage = S3Storage(
+            content_cache=ThreadCheckingContentCache(cache_dir)
+        )
+        storage.cache = None
+        storage._async_connection = AsyncHeadConnection()
+
+        async def run():
+            for i in range(2):
+                file_ = await storage.aopen('file.txt')
+                self.assertEqual(await file_.aread(), b'Lorem ipsum')
+
+        try:
+            asyncio.run(run())
+        finally:
+            shutil.rmtree(cache_dir)
+        self.assertEqual(storage.content_cache.blocking, [])
+        # The second read came from the cache
+        self.assertEqual(storage._async_connection.requests,
+                         [('GET', 'file.txt')])
+
+    def test_async_close(self):
+        import asyncio
+
+        class View(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        file_ = S3Storage().open('file.css')
+        # A gzipped file being read holds a streaming response open
+        file_._gzip = View()
+        asyncio.run(file_.aclose())
+        self.assertTrue(file_._gzip.closed)
+
+    def test_async_save_checks_name(self):
+        import asyncio
+
+        storage = S3Storage()
+        storage.cache = None
+        storage.connection = HeadConnection()
+
+        async def run():
+            with self.assertRaises(SuspiciousFileOperation):
+                await storage.asave('dir/../../etc.txt', ContentFile(b'a'))
+
+        asyncio.run(run())
+        self.assertEqual(storage.connection.requests, [])
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD=1,
+                       CUDDLYBUDDLY_STORAGE_S3_MULTIPART_PART_SIZE=1)
+    def test_async_multipart_upload(self):
+        import asyncio
+
+        async def run():
+            data = os.urandom(MIN_PART_SIZE * 2 + 100)
+            filename = await default_storage.asave(
+                'testsdir/fileasyncmultipart.bin',
+                ContentFile(data)
+            )
+            self.assertEqual(await default_storage.asize(filename), len(data))
+            file_ = await default_storage.aopen(filename)
+            self.assertEqual(await file_.aread(), data)
+            await default_storage.adelete(filename)
+
+        asyncio.run(run())
+
+
+class ConnectionPoolTests(TestCase):
+    def test_reuse(self):
+        pool = ConnectionPool(max_size=1)
+        self.assertEqual(pool.get(True, 'example.com:443'), None)
+        conn, conn2 = DummyConnection(), DummyConnection()
+        pool.put(True, 'example.com:443', conn)
+        pool.put(True, 'example.com:443', conn2)
+        self.assertEqual(conn2.sock, None)
+        self.assertEqual(pool.get(False, 'example.com:443'), None)
+        self.assertEqual(pool.get(True, 'example.com:443'), conn)
+        self.assertEqual(pool.get(True, 'example.com:443'), None)
+
+    def test_closed_connections_are_dropped(self):
+        pool = ConnectionPool()
+        conn = DummyConnection()
+        conn.close()
+        pool.put(True, 'example.com:443', conn)
+        self.assertEqual(pool.get(True, 'example.com:443'), None)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0)
+        conn = DummyConnection()
+        pool.put(True, 'example.com:443', conn)
+        sleep(0.01)
+        self.assertEqual(pool.get(True, 'example.com:443'), None)
+        self.assertEqual(conn.sock, None)
+
+    def test_fork(self):
+        pool = ConnectionPool()
+        conn = DummyConnection()
+        pool.put(True, 'example.com:443', conn)
+        pool._pid = -1
+        self.assertEqual(pool.get(True, 'example.com:443'), None)
+        # Sockets shared with the parent process must not be closed
+        self.assertTrue(conn.sock is not None)
+        conn.close()
+
+
+class SessionSocket(object):
+    def __init__(self, session):
+        self.session = session
+
+
+class UnixSocket(object):
+    """
+    A socketpair socket which ignores the TCP options set when connecting.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def setsockopt(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class FakeSSLSocket(object):
+    """
+    Stands in for an SSLSocket around a plain socket, always ending up with
+    a new session unless it resumed one.
+    """
+
+    def __init__(self, sock, session):
+        self._sock = sock
+        self.session_reused = session is not None
+        self.session = 'new-session'
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class FakeSSLContext(object):
+    verify_mode = ssl.CERT_REQUIRED
+    check_hostname = True
+
+    def __init__(self, reject_sessions=False):
+        self.reject_sessions = reject_sessions
+        self.sessions = []
+
+    def wrap_socket(self, sock, server_hostname=None, session=None):
+        self.sessions.append(session)
+        if session is not None and self.reject_sessions:
+            raise ssl.SSLError('The session was rejected')
+        return FakeSSLSocket(sock, session)
+
+
+@skipIf(sys.version_info < (3, 6), 'Requires TLS session resumption')
+class TLSSessionTests(TestCase):
+    def connect(self, context, sessions):
+        conn = HTTPSConnection('example.com', tls_sessions=sessions,
+                               context=context)
+        peers = []
+
+        def create_connection(*args):
+            sock, peer = socket.socketpair()
+            peers.append(peer)
+            return UnixSocket(sock)
+
+        conn._create_connection = create_connection
+        conn.connect()
+        # Answer a request so the session is saved after the response.
+        peers[-1].sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        conn.request('GET', '/')
+        conn.getresponse().read()
+        conn.close()
+        for peer in peers:
+            peer.close()
+        return peers
+
+    def test_max_size(self):
+        sessions = TLSSessionCache(max_size=2)
+        sessions.save('a.example.com', SessionSocket('a'))
+        sessions.save('b.example.com', SessionSocket('b'))
+        sessions.save('b.example.com', SessionSocket('b2'))
+        self.assertEqual(sessions.get('a.example.com'), 'a')
+        sessions.save('c.example.com', SessionSocket('c'))
+        self.assertEqual(sessions.get('a.example.com'), None)
+        self.assertEqual(sessions.get('b.example.com'), 'b2')
+        self.assertEqual(sessions.get('c.example.com'), 'c')
+        sessions.save('d.example.com', SessionSocket(None))
+        self.assertEqual(sessions.get('d.example.com'), None)
+
+    def test_new_session(self):
+        context, sessions = FakeSSLContext(), TLSSessionCache()
+        self.connect(context, sessions)
+        self.assertEqual(context.sessions, [None])
+        self.assertEqual(sessions.get('example.com'), 'new-session')
+
+    def test_resumed_session(self):
+        context, sessions = FakeSSLContext(), TLSSessionCache()
+        sessions.save('example.com', SessionSocket('old-session'))
+        self.connect(context, sessions)
+        self.assertEqual(context.sessions, ['old-session'])
+        # A resumed session isn't saved again
+        self.assertEqual(sessions.get('example.com'), 'old-session')
+
+    def test_rejected_session(self):
+        context = FakeSSLContext(reject_sessions=True)
+        sessions = TLSSessionCache()
+        sessions.save('example.com', SessionSocket('old-session'))
+        peers = self.connect(context, sessions)
+        # It falls back to a full handshake over a new connection
+        self.assertEqual(context.sessions, ['old-session', None])
+        self.assertEqual(len(peers), 2)
+        self.assertEqual(sessions.get('example.com'), 'new-session')
+
+
+class EndpointCacheTests(TestCase):
+    def test_ttl(self):
+        cache = lib.EndpointCache(ttl=60)
+        cache.set('bucket', True, 'bucket.s3.eu-west-1.amazonaws.com:443')
+        self.assertEqual(
+            cache.get('bucket'),
+            (True, 'bucket.s3.eu-west-1.amazonaws.com:443')
+        )
+        self.assertEqual(cache.get('other'), None)
+        cache.ttl = -1
+        cache.set('bucket', True, 'bucket.s3.eu-west-1.amazonaws.com:443')
+        self.assertEqual(cache.get('bucket'), None)
+
+    def test_location_endpoint(self):
+        self.assertEqual(lib.Location.endpoint(''), lib.DEFAULT_HOST)
+        self.assertEqual(
+            lib.Location.endpoint(lib.Location.EU),
+            's3.eu-west-1.amazonaws.com'
+        )
+        self.assertEqual(
+            lib.Location.endpoint('ap-southeast-2'),
+            's3.ap-southeast-2.amazonaws.com'
+        )
+
+
+class UnseekableFile(object):
+    def read(self, num_bytes=None):
+        return b''
+
+
+class RetryPolicyTests(TestCase):
+    def test_retryable(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable('GET', ''))
+        self.assertTrue(policy.is_retryable('PUT', b'Lorem ipsum'))
+        self.assertTrue(policy.is_retryable('PUT', StringIO(b'Lorem ipsum')))
+        self.assertTrue(not policy.is_retryable('PUT', UnseekableFile()))
+        self.assertTrue(not policy.is_retryable('POST', ''))
+        self.assertTrue(policy.is_retryable_status(503))
+        self.assertTrue(not policy.is_retryable_status(404))
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+        for i in range(10):
+            self.assertTrue(0 <= policy.delay(1) <= 1)
+            self.assertTrue(0 <= policy.delay(5) <= 3)
+
+    def test_budget(self):
+        policy = RetryPolicy(max_attempts=10, budget=RetryBudget(
+            capacity=10, retry_cost=5, success_deposit=5
+        ))
+        self.assertTrue(policy.should_retry(1))
+        self.assertTrue(policy.should_retry(1))
+        self.assertTrue(not policy.should_retry(1))
+        policy.succeeded()
+        self.assertTrue(policy.should_retry(1))
+        policy.succeeded()
+        self.assertTrue(not policy.should_retry(10))
+
+
+class TimeoutsTests(TestCase):
+    def test_nesting(self):
+        self.assertEqual(lib.current_timeouts(), None)
+        with lib.Timeouts(deadline=1, read=5) as outer:
+            with lib.Timeouts(deadline=10, connect=2) as inner:
+                self.assertEqual(lib.current_timeouts(), inner)
+                self.assertEqual(inner.expires, outer.expires)
+                self.assertEqual((inner.connect, inner.read), (2, 5))
+            self.assertEqual(lib.current_timeouts(), outer)
+        self.assertEqual(lib.current_timeouts(), None)
+
+    def test_min_timeout(self):
+        self.assertEqual(lib.min_timeout(None, None), None)
+        self.assertEqual(lib.min_timeout(None, 3, 2), 2)
+
+
+class RateLimiterTests(TestCase):
+    def test_aimd(self):
+        limiter = AdaptiveRateLimiter(read_rate=100, write_rate=50,
+                                      min_rate=10, increase=5, cooldown=60)
+        self.assertEqual(limiter.rate('bucket', 'GET', 'file.txt'), 100)
+        self.assertEqual(limiter.rate('bucket', 'GET', ''), 50)
+        limiter.throttled('bucket', 'GET', 'file.txt')
+        self.assertEqual(limiter.rate('bucket', 'GET', 'file.txt'), 50)
+        # Only one decrease per cooldown
+        limiter.throttled('bucket', 'GET', 'file.txt')
+        self.assertEqual(limiter.rate('bucket', 'GET', 'file.txt'), 50)
+        self.assertEqual(limiter.rate('bucket', 'PUT', 'file.txt'), 50)
+        self.assertEqual(limiter.rate('other', 'GET', 'file.txt'), 100)
+        limiter.succeeded('bucket', 'GET', 'file.txt')
+        self.assertEqual(limiter.rate('bucket', 'GET', 'file.txt'), 55)
+
+    def test_acquire(self):
+        limiter = AdaptiveRateLimiter(read_rate=10)
+        for i in range(10):
+            self.assertTrue(limiter.acquire('bucket', 'GET', 'file.txt'))
+        # The bucket is empty so the next request would have to wait
+        self.assertTrue(not limiter.acquire(
+            'bucket', 'GET', 'file.txt', expires=0
+        ))
+
+    def test_reserve(self):
+        limiter = AdaptiveRateLimiter(read_rate=10)
+        for i in range(10):
+            self.assertEqual(limiter.reserve('bucket', 'GET', 'file.txt'), 0)
+        # The wait is returned for async requests to sleep on
+        self.assertTrue(limiter.reserve('bucket', 'GET', 'file.txt') > 0)
+        self.assertEqual(
+            limiter.reserve('bucket', 'GET', 'file.txt', expires=0),
+            None
+        )
+
+
+class MultipartTests(TestCase):
+    def test_part_size(self):
+        self.assertEqual(get_part_size(100, 1), MIN_PART_SIZE)
+        self.assertEqual(get_part_size(100 * 1024 * 1024), 16 * 1024 * 1024)
+        size = 10001 * MIN_PART_SIZE
+        part_size = get_part_size(size, MIN_PART_SIZE)
+        self.assertTrue(part_size > MIN_PART_SIZE)
+        self.assertTrue(part_size * 10000 >= size)
+
+    def test_canonical_string(self):
+        c_string = lib.canonical_string(
+            'PUT', 'bucket', 'file.txt',
+            {'uploadId': 'abc', 'partNumber': 2, 'other': 'x'}
+        )
+        self.assertTrue(c_string.endswith(
+            '/bucket/file.txt?partNumber=2&uploadId=abc'
+        ))
+        c_string = lib.canonical_string('POST', 'bucket', 'file.txt',
+                                        {'uploads': None})
+        self.assertTrue(c_string.endswith('/bucket/file.txt?uploads'))
+
+
+class CompressTests(TestCase):
+    def test_gzip_stream(self):
+        data = b'Lorem ipsum ' * 10000
+        stream = GzipStream(StringIO(data), chunk_size=100)
+        chunks = []
+        while True:
+            chunk = stream.read(1000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(stream.raw_length, len(data))
+        self.assertEqual(stream.length, sum(len(c) for c in chunks))
+        gzf = GzipFile(mode='rb', fileobj=StringIO(b''.join(chunks)))
+        self.assertEqual(gzf.read(), data)
+
+    def test_should_gzip(self):
+        history = CompressionHistory()
+        content = StringIO(os.urandom(2048))
+        self.assertTrue(not should_gzip(content, 'text/css', history))
+        self.assertEqual(content.tell(), 0)
+        self.assertTrue(should_gzip(StringIO(b'Lorem ipsum ' * 512),
+                                    'text/css', history))
+        history.record('text/css', 1000, 100)
+        self.assertTrue(should_gzip(content, 'text/css', history))
+        self.assertTrue(not should_gzip(content, 'text/javascript', history))
+
+    def test_gzip_view(self):
+        data = os.urandom(1000) * 100
+        compressed = GzipStream(StringIO(data)).read()
+        requests = []
+
+        def stream(offset):
+            requests.append(offset)
+            for i in range(offset, len(compressed), 100):
+                yield compressed[i:i + 100]
+
+        view = GzipView(stream, interval=10000, max_checkpoints=4)
+        self.assertEqual(view.read(0, 99), data[:100])
+        self.assertEqual(view.read(100, 199), data[100:200])
+        self.assertEqual(requests, [0])
+        self.assertEqual(view.read(50000), data[50000:])
+        self.assertEqual(view.size, len(data))
+        self.assertEqual(view.read(95000, 95099), data[95000:95100])
+        self.assertEqual(view.read(len(data)), b'')
+        # Checkpoints were thinned out instead of growing past the maximum
+        self.assertTrue(len(view._checkpoints) <= 4)
+        self.assertTrue(requests[-1] > 0)
+        chunks = gunzip_chunks([compressed[:10], compressed[10:]])
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_wrapped_gzip_size(self):
+        data = os.urandom(100000)
+        gzipped = StringIO()
+        with GzipFile(fileobj=gzipped, mode='wb') as file_:
+            file_.write(data)
+        gzipped = gzipped.getvalue()
+
+        class Storage(object):
+            def _read_block(self, name, start, end, etag=None):
+                # The stored size as if it were 2**32 + 5
+                return b'\x05\x00\x00\x00', {}
+
+            def _read_compressed(self, name, offset=0, etag=None):
+                yield gzipped[offset:]
+
+        file_ = S3StorageFile.__new__(S3StorageFile)
+        file_.name, file_._storage, file_._etag = 'file.css', Storage(), None
+        file_._compressed_size = len(gzipped)
+        file_._gzip = GzipView(lambda offset: iter([]))
+        self.assertEqual(file_._gzip_size(), len(data))
+
+class ReadAheadBufferTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(1000)
+        self.fetches = []
+
+    def fetch(self, start, end):
+        self.fetches.append((start, end))
+        return self.data[start:end + 1], len(self.data)
+
+    def test_blocks(self):
+        buffer_ = ReadAheadBuffer(self.fetch, block_size=100, max_read_ahead=0)
+        self.assertEqual(buffer_.read(10, 20), self.data[10:30])
+        self.assertEqual(buffer_.read(50, 100), self.data[50:150])
+        self.assertEqual(buffer_.read(0, 10), self.data[0:10])
+        self.assertEqual(self.fetches, [(0, 99), (100, 199)])
+        self.assertEqual(buffer_.read(990, 100), self.data[990:])
+        self.assertEqual(buffer_.read(1000, 100), b'')
+        self.assertEqual(self.fetches, [(0, 99), (100, 199), (900, 999)])
+
+    def test_read_ahead(self):
+        buffer_ = ReadAheadBuffer(self.fetch, block_size=100,
+                                  max_read_ahead=200)
+        data = []
+        for pos in range(0, 1000, 10):
+            data.append(buffer_.read(pos, 10))
+        self.assertEqual(b''.join(data), self.data)
+        # Each fetch gets the block being read and up to 2 blocks ahead
+        self.assertEqual(self.fetches, [
+            (0, 99), (100, 299), (300, 599), (600, 899), (900, 999)
+        ])
+
+    def test_lru(self):
+        buffer_ = ReadAheadBuffer(self.fetch, block_size=100,
+                                  max_read_ahead=0, max_blocks=2)
+        buffer_.read(0, 1)
+        buffer_.read(500, 1)
+        buffer_.read(0, 1)
+        buffer_.read(900, 1)
+        buffer_.read(0, 1)
+        self.assertEqual(len(self.fetches), 3)
+        buffer_.read(500, 1)
+        self.assertEqual(len(self.fetches), 4)
+
+    def test_coalesce_ranges(self):
+        self.assertEqual(
+            coalesce_ranges([(0, 10), (500, 10), (15, 5), (8, 4), (50, 0)],
+                            gap=5),
+            [(0, 20, [0, 3, 2]), (500, 510, [1])]
+        )
+        self.assertEqual(coalesce_ranges([(0, 10), (16, 4)], gap=5),
+                         [(0, 10, [0]), (16, 20, [1])])
+
+
+class ContentCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_save_and_get(self):
+        cache = ContentCache(self.cache_dir, max_size=1000, max_file_size=100)
+        self.assertEqual(cache.get('a.txt'), None)
+        self.assertTrue(cache.save('a.txt', '"etag"', b'Lorem ipsum'))
+        self.assertEqual(cache.get('a.txt'), ('"etag"', b'Lorem ipsum'))
+        if hasattr(os, 'fchmod'):
+            mode = os.stat(cache._path('a.txt')).st_mode
+            self.assertEqual(mode & 0o777, FILE_MODE)
+        self.assertEqual(cache.get('a.txt', '"other"'), None)
+        self.assertTrue(not cache.save('b.txt', '"etag"', b'x' * 101))
+        self.assertEqual(cache.get('b.txt'), None)
+        cache.remove('a.txt')
+        self.assertEqual(cache.get('a.txt'), None)
+        # Nothing but cached files is left behind
+        self.assertEqual(
+            [f for root, dirs, files in os.walk(self.cache_dir) for f in files],
+            []
+        )
+
+    def test_mmap(self):
+        cache = ContentCache(self.cache_dir, max_size=1000, max_file_size=100,
+                             use_mmap=True)
+        cache.save('a.txt', '"etag"', b'Lorem ipsum')
+        etag, data = cache.get('a.txt')
+        self.assertEqual(bytes(data[6:]), b'ipsum')
+        cache.save('b.txt', '"etag"', b'')
+        self.assertEqual(cache.get('b.txt'), ('"etag"', b''))
+        storage = S3Storage(content_cache=cache)
+        file_ = storage.open('c.txt')
+        file_._save_content('"etag"', b'Lorem ipsum')
+        file_._use_cached(cache.get(storage._content_key('c.txt')))
+        self.assertEqual(file_.read(5), b'Lorem')
+        # Closing the file lets go of the mapping
+        file_.close()
+        self.assertEqual(file_._content, None)
+
+    def test_lru(self):
+        cache = ContentCache(self.cache_dir, max_size=250, max_file_size=100)
+        cache.save('a.txt', '"a"', b'a' * 100)
+        cache.save('b.txt', '"b"', b'b' * 100)
+        cache.get('a.txt')
+        cache.save('c.txt', '"c"', b'c' * 100)
+        self.assertEqual(cache.get('b.txt'), None)
+        self.assertNotEqual(cache.get('a.txt'), None)
+        self.assertNotEqual(cache.get('c.txt'), None)
+        # Another process sharing the directory sees the same files
+        other = ContentCache(self.cache_dir, max_size=250, max_file_size=100)
+        self.assertEqual(other.get('c.txt'), ('"c"', b'c' * 100))
+        self.assertEqual(other._total, cache._total)
+
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_REVALIDATE=False)
+    def test_etag_from_request(self):
+        storage = S3Storage(content_cache=ContentCache(self.cache_dir))
+        storage.content_cache.save(storage._content_key('file.txt'), '"old"',
+                                   b'Lorem ipsum')
+        self.assertEqual(storage._cached_content('file.txt'),
+                         ('"old"', b'Lorem ipsum'))
+        response = HeadResponse(200)
+        set_request_memo({'file.txt': response})
+        try:
+            response.headers['ETag'] = '"old"'
+            self.assertEqual(storage._cached_content('file.txt'),
+                             ('"old"', b'Lorem ipsum'))
+            # Changed by another server since it was cached
+            response.headers['ETag'] = '"new"'
+            self.assertEqual(storage._cached_content('file.txt'), None)
+        finally:
+            set_request_memo(None)
+
+    def test_storages_sharing_cache_dir(self):
+        media = S3Storage(bucket='media',
+                          content_cache=ContentCache(self.cache_dir))
+        static = S3Storage(bucket='static',
+                           content_cache=ContentCache(self.cache_dir))
+        file_ = media.open('css/site.css')
+        self.assertTrue(file_._save_content('"media"', b'media'))
+        self.assertEqual(media._cached_content('css/site.css'),
+                         ('"media"', b'media'))
+        self.assertEqual(static._cached_content('css/site.css'), None)
+
+class SingleFlightTests(TestCase):
+    def test_shared_result(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def call(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', call, 1)))
+        leader.start()
+        started.wait()
+        followers = [
+            threading.Thread(
+                target=lambda: results.append(flights.do('key', call, 2)))
+            for i in range(5)
+        ]
+        for thread in followers:
+            thread.start()
+        # Give the followers a chance to start waiting
+        sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1] * 6)
+        # Finished calls aren't reused
+        self.assertEqual(flights.do('key', call, 3), 3)
+
+    def test_shared_error(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def call():
+            started.set()
+            release.wait()
+            raise S3Error('Failed')
+
+        errors = []
+
+        def run():
+            try:
+                flights.do('key', call)
+            except S3Error as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+
+
+class MetadataCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_memory_cache(self):
+        cache = MemoryCache(max_entries=2, timeout=None)
+        self.assertEqual(cache.exists('a.txt'), None)
+        self.assertEqual(cache.size('a.txt'), None)
+        cache.save('a.txt', 10, 1000.0)
+        cache.save('b.txt', 20, 2000.0)
+        self.assertTrue(cache.exists('a.txt'))
+        cache.save('c.txt', 30, 3000.0)
+        # b.txt was the least recently used
+        self.assertEqual(cache.size('b.txt'), None)
+        self.assertEqual(cache.size('a.txt'), 10)
+        self.assertEqual(cache.modified_time('c.txt'), 3000.0)
+        cache.remove('a.txt')
+        self.assertEqual(cache.size('a.txt'), None)
+
+    def test_memory_cache_timeout(self):
+        cache = MemoryCache(timeout=0.1)
+        cache.save('a.txt', 10, 1000.0)
+        self.assertEqual(cache.size('a.txt'), 10)
+        sleep(0.2)
+        self.assertEqual(cache.size('a.txt'), None)
+
+    def test_file_system_cache(self):
+        cache = FileSystemCache(self.cache_dir)
+        self.assertEqual(cache.get('a.txt'), None)
+        cache.remove('a.txt')
+        cache.save('a.txt', 10, 1000)
+        self.assertEqual(cache.get('a.txt'), {'size': 10, 'mtime': 1000.0})
+        self.assertEqual(cache.size('a.txt'), 10)
+        self.assertEqual(cache.modified_time('a.txt'), 1000.0)
+        cache.save('a.txt', 20, 2000)
+        self.assertEqual(cache.get('a.txt'), {'size': 20, 'mtime': 2000.0})
+        # Records are sharded and no temporary files are left behind
+        paths = [
+            os.path.relpath(os.path.join(root, f), self.cache_dir)
+            for root, dirs, files in os.walk(self.cache_dir) for f in files
+        ]
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(len(paths[0].split(os.sep)), 3)
+        # Records can be read by processes run by other users
+        if hasattr(os, 'fchmod'):
+            mode = os.stat(os.path.join(self.cache_dir, paths[0])).st_mode
+            self.assertEqual(mode & 0o777, FILE_MODE)
+        with open(os.path.join(self.cache_dir, paths[0]), 'wb') as file_:
+            file_.write(b'a.txt\n10\n1000')
+        self.assertEqual(cache.get('a.txt'), None)
+        cache.remove('a.txt')
+        self.assertEqual(cache.size('a.txt'), None)
+
+    def test_chain_cache(self):
+        memory = MemoryCache()
+        filesystem = FileSystemCache(self.cache_dir)
+        cache = ChainCache([memory, filesystem])
+        cache.save('a.txt', 10, 1000.0)
+        self.assertEqual(memory.size('a.txt'), 10)
+        self.assertEqual(filesystem.size('a.txt'), 10)
+        memory.remove('a.txt')
+        self.assertEqual(cache.modified_time('a.txt'), 1000.0)
+        # Found in the file system so copied back into memory
+        self.assertEqual(memory.size('a.txt'), 10)
+        cache.remove('a.txt')
+        self.assertEqual(cache.size('a.txt'), None)
+        self.assertEqual(filesystem.size('a.txt'), None)
+
+    def test_negative_caching(self):
+        for cache in (MemoryCache(negative_ttl=0.1),
+                      FileSystemCache(self.cache_dir, negative_ttl=0.1)):
+            self.assertEqual(cache.exists('a.txt'), None)
+            cache.save_missing('a.txt')
+            self.assertEqual(cache.exists('a.txt'), False)
+            self.assertEqual(cache.size('a.txt'), None)
+            self.assertEqual(cache.get('a.txt'), None)
+            sleep(0.2)
+            self.assertEqual(cache.exists('a.txt'), None)
+            cache.save_missing('a.txt')
+            cache.save('a.txt', 10, 1000)
+            self.assertEqual(cache.exists('a.txt'), True)
+            cache.remove('a.txt')
+            cache.save_missing('a.txt')
+            cache.remove('a.txt')
+            self.assertEqual(cache.exists('a.txt'), None)
+
+    def test_chain_cache_negative_caching(self):
+        memory = MemoryCache()
+        filesystem = FileSystemCache(self.cache_dir)
+        cache = ChainCache([memory, filesystem])
+        filesystem.save_missing('a.txt')
+        self.assertEqual(cache.exists('a.txt'), False)
+        self.assertEqual(memory.exists('a.txt'), False)
+        cache.save('a.txt', 10, 1000)
+        self.assertEqual(memory.exists('a.txt'), True)
+        self.assertEqual(filesystem.exists('a.txt'), True)
+
+    def test_chain_cache_many(self):
+        memory = MemoryCache()
+        filesystem = FileSystemCache(self.cache_dir)
+        cache = ChainCache([memory, filesystem])
+        cache.save_many({
+            'a.txt': {'size': 10, 'mtime': 1000.0},
+            'b.txt': {'size': 20, 'mtime': 2000.0}
+        })
+        memory.remove('b.txt')
+        filesystem.save_missing('c.txt')
+        self.assertEqual(cache.get_many(['a.txt', 'b.txt', 'c.txt', 'd.txt']), {
+            'a.txt': {'size': 10, 'mtime': 1000.0},
+            'b.txt': {'size': 20, 'mtime': 2000.0},
+            'c.txt': None
+        })
+        self.assertEqual(memory.get('b.txt'), {'size': 20, 'mtime': 2000.0})
+        self.assertEqual(memory.exists('c.txt'), False)
+        cache.remove_many(['a.txt', 'b.txt'])
+        self.assertEqual(filesystem.get_many(['a.txt', 'b.txt']), {})
+
+    @override_settings(CACHES={'cbs3': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }})
+    def test_django_cache(self):
+        cache = DjangoCache('cbs3')
+        self.assertEqual(cache.exists('a.txt'), None)
+        cache.save('a.txt', 10, 1000)
+        self.assertEqual(cache.get('a.txt'), {'size': 10, 'mtime': 1000.0})
+        self.assertEqual(cache.exists('a.txt'), True)
+        self.assertEqual(cache.size('a.txt'), 10)
+        self.assertEqual(cache.modified_time('a.txt'), 1000.0)
+        cache.save_missing('b.txt')
+        self.assertEqual(cache.exists('b.txt'), False)
+        self.assertEqual(cache.get('b.txt'), None)
+        cache.save_many({
+            'c.txt': {'size': 30, 'mtime': 3000.0},
+            'd.txt': {'size': 40, 'mtime': 4000.0}
+        })
+        self.assertEqual(cache.get_many(['a.txt', 'b.txt', 'c.txt', 'd.txt',
+                                         'e.txt']), {
+            'a.txt': {'size': 10, 'mtime': 1000.0},
+            'b.txt': None,
+            'c.txt': {'size': 30, 'mtime': 3000.0},
+            'd.txt': {'size': 40, 'mtime': 4000.0}
+        })
+        cache.remove_many(['a.txt', 'c.txt'])
+        cache.remove('d.txt')
+        self.assertEqual(cache.get_many(['a.txt', 'c.txt', 'd.txt']), {})
+        cache.save_missing_many(['a.txt', 'c.txt'])
+        self.assertEqual(cache.get_many(['a.txt', 'c.txt', 'd.txt']),
+                         {'a.txt': None, 'c.txt': None})
+
+    @override_settings(CACHES={'cbs3': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cbs3-timeout',
+        'TIMEOUT': 60
+    }})
+    def test_django_cache_timeout(self):
+        backend = caches['cbs3']
+        now = time()
+        DjangoCache('cbs3').save('a.txt', 10, 1000)
+        expires = backend._expire_info[backend.make_key(
+            DjangoCache('cbs3')._key('a.txt'))]
+        self.assertTrue(now + 59 <= expires <= now + 61)
+        with self.settings(CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE_TIMEOUT=None):
+            DjangoCache('cbs3').save('b.txt', 20, 2000)
+        self.assertEqual(backend._expire_info[backend.make_key(
+            DjangoCache('cbs3')._key('b.txt'))], None)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_CACHE=[
+        'cuddlybuddly.storage.s3.cache.MemoryCache',
+        'cuddlybuddly.storage.s3.cache.FileSystemCache'
+    ])
+    def test_cache_setting(self):
+        storage = S3Storage()
+        self.assertTrue(isinstance(storage.cache, ChainCache))
+        self.assertEqual([type(c) for c in storage.cache.caches],
+                         [MemoryCache, FileSystemCache])
+
+
+class HeadResponse(object):
+    def __init__(self, status):
+        self.status = status
+        self.headers = {
+            'Content-Length': '11',
+            'Last-Modified': 'Sun, 01 Jan 2012 00:00:00 GMT'
+        }
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class HeadConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def _make_request(self, method, bucket, key):
+        self.requests.append((method, key))
+        if 'error' in key:
+            return HeadResponse(503)
+        return HeadResponse(404 if 'missing' in key else 200)
+
+
+class ListConnection(HeadConnection):
+    truncated = False
+
+    def list_bucket(self, bucket, options={}):
+        self.requests.append(('LIST', options['prefix']))
+        response = lib.ListBucketResponse.__new__(lib.ListBucketResponse)
+        response.http_response = HeadResponse(200)
+        response.entries = [
+            lib.ListEntry('dir/file%s.txt' % i, '2012-01-01T00:00:00.000Z',
+                          size=i)
+            for i in range(10)
+        ]
+        response.is_truncated = self.truncated
+        return response
+
+
+class AsyncHeadConnection(HeadConnection):
+    def _response(self, status):
+        response = lib.Response.__new__(lib.Response)
+        response.http_response = HeadResponse(status)
+        return response
+
+    async def head(self, bucket, key, headers={}):
+        self.requests.append(('HEAD', key))
+        return self._response(404 if 'missing' in key else 200)
+
+    async def delete(self, bucket, key, headers={}):
+        self.requests.append(('DELETE', key))
+        return self._response(204)
+
+    async def get(self, bucket, key, headers={}):
+        self.requests.append(('GET', key))
+        response = self._response(200)
+        response.http_response.msg = {'etag': '"etag"'}
+        response.object = lib.S3Object(b'Lorem ipsum')
+        return response
+
+
+class ThreadCheckingCache(MemoryCache):
+    """
+    Records the methods called on the main thread, which runs the event loop
+    in the async tests.
+    """
+
+    def __init__(self):
+        MemoryCache.__init__(self)
+        self.blocking = []
+
+    def _check(self, method):
+        if threading.current_thread().name == 'MainThread':
+            self.blocking.append(method)
+
+    def exists(self, name):
+        self._check('exists')
+        return MemoryCache.exists(self, name)
+
+    def size(self, name):
+        self._check('size')
+        return MemoryCache.size(self, name)
+
+    def modified_time(self, name):
+        self._check('modified_time')
+        return MemoryCache.modified_time(self, name)
+
+    def save(self, name, size, mtime):
+        self._check('save')
+        MemoryCache.save(self, name, size, mtime)
+
+    def save_missing(self, name):
+        self._check('save_missing')
+        MemoryCache.save_missing(self, name)
+
+    def remove(self, name):
+        self._check('remove')
+        MemoryCache.remove(self, name)
+
+
+class ThreadCheckingContentCache(ContentCache):
+    def __init__(self, cache_dir):
+        ContentCache.__init__(self, cache_dir)
+        self.blocking = []
+
+    def get(self, name, etag=None):
+        if threading.current_thread().name == 'MainThread':
+            self.blocking.append('get')
+        return ContentCache.get(self, name, etag)
+
+    def save(self, name, etag, data):
+        if threading.current_thread().name == 'MainThread':
+            self.blocking.append('save')
+        return ContentCache.save(self, name, etag, data)
+
+
+class CountingCache(object):
+    """
+    Records the methods called on a Django cache.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self._cache, name)
+
+
+class CountingDjangoCache(DjangoCache):
+    @property
+    def cache(self):
+        if not hasattr(self, '_counting'):
+            self._counting = CountingCache(caches[self.alias])
+        return self._counting
+
+
+class StatManyTests(TestCase):
+    def test_stat_many(self):
+        storage = S3Storage()
+        storage.cache = MemoryCache()
+        storage.connection = ListConnection()
+        names = ['dir/file%s.txt' % i for i in range(6)] + \
+            ['dir/missing.txt', 'other/file.txt', 'other/missing.txt']
+        stats = storage.stat_many(names)
+        mtime = datetime.fromtimestamp(1325376000)
+        self.assertEqual(stats['dir/file3.txt'],
+                         {'size': 3, 'modified_time': mtime})
+        self.assertEqual(stats['other/file.txt'],
+                         {'size': 11, 'modified_time': mtime})
+        self.assertEqual(stats['dir/missing.txt'], None)
+        self.assertEqual(stats['other/missing.txt'], None)
+        self.assertEqual(sorted(storage.connection.requests), [
+            ('HEAD', 'other/file.txt'), ('HEAD', 'other/missing.txt'),
+            ('LIST', 'dir/')
+        ])
+        # Everything, even the missing files, is now cached
+        self.assertEqual(storage.stat_many(names), stats)
+        self.assertEqual(len(storage.connection.requests), 3)
+
+    @override_settings(CACHES={'cbs3': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }})
+    def test_stat_many_batches_cache_calls(self):
+        storage = S3Storage()
+        storage.cache = CountingDjangoCache('cbs3')
+        storage.connection = ListConnection()
+        names = ['other/file%s.txt' % i for i in range(2)] + \
+            ['other/missing%s.txt' % i for i in range(2)]
+        stats = storage.stat_many(names)
+        self.assertEqual(stats['other/missing1.txt'], None)
+        self.assertEqual(storage.cache.cache.calls,
+                         ['get_many', 'set_many', 'set_many'])
+        storage.cache.cache.calls = []
+        self.assertEqual(storage.stat_many(names), stats)
+        self.assertEqual(storage.cache.cache.calls, ['get_many'])
+        self.assertEqual(len(storage.connection.requests), 4)
+
+    @override_settings(CACHES={'cbs3': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }})
+    def test_stat_many_mixed_batch(self):
+        storage = S3Storage()
+        storage.cache = CountingDjangoCache('cbs3')
+        storage.connection = ListConnection()
+        storage.connection.truncated = True
+        names = ['dir/file%s.txt' % i for i in range(4)] + \
+            ['dir/absent.txt', 'dir/missing.txt', 'other/file.txt',
+             'other/missing.txt']
+        stats = storage.stat_many(names)
+        self.assertEqual(stats['dir/file2.txt']['size'], 2)
+        self.assertEqual(stats['other/file.txt']['size'], 11)
+        for name in ('dir/absent.txt', 'dir/missing.txt', 'other/missing.txt'):
+            self.assertEqual(stats[name], None)
+        # dir/absent.txt comes before the end of the first page of the
+        # listing so it isn't looked up again, only dir/missing.txt is.
+        self.assertEqual(sorted(storage.connection.requests), [
+            ('HEAD', 'dir/missing.txt'), ('HEAD', 'other/file.txt'),
+            ('HEAD', 'other/missing.txt'), ('LIST', 'dir/')
+        ])
+        # One write for the files and one for all the missing ones
+        self.assertEqual(storage.cache.cache.calls,
+                         ['get_many', 'set_many', 'set_many'])
+        storage.cache.cache.calls = []
+        self.assertEqual(storage.stat_many(names), stats)
+        self.assertEqual(storage.cache.cache.calls, ['get_many'])
+        self.assertEqual(len(storage.connection.requests), 4)
+
+
+class RequestMemoTests(TestCase):
+    def test_memo(self):
+        storage = S3Storage()
+        storage.cache = None
+        storage.connection = HeadConnection()
+        middleware = ThreadLocals(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.assertTrue(storage.exists('file.txt'))
+        self.assertEqual(storage.size('file.txt'), 11)
+        storage.modified_time('file.txt')
+        self.assertTrue(not storage.exists('missing.txt'))
+        self.assertTrue(not storage.exists('missing.txt'))
+        self.assertEqual(storage.connection.requests,
+                         [('HEAD', 'file.txt'), ('HEAD', 'missing.txt')])
+        storage.exists('missing.txt', force_check=True)
+        self.assertEqual(len(storage.connection.requests), 3)
+        # Errors aren't remembered
+        storage.exists('error.txt')
+        storage.exists('error.txt')
+        self.assertEqual(len(storage.connection.requests), 5)
+        middleware.process_response(request, HttpResponse())
+        storage.exists('file.txt')
+        self.assertEqual(len(storage.connection.requests), 6)
+
+
 class SignedURLTests(TestCase):
     def setUp(self):
         self.conn = lib.AWSAuthConnection(